@@ -18,24 +18,49 @@ subprocess module for local commands, and by wrapping
 #===============================================================================
 __version__ = "0.2.1"
 #===============================================================================
-import subprocess,os,errno,sys
+import subprocess,os,errno,socket,shlex,threading,asyncio
 #===============================================================================
 from click import prompt,confirm,echo
 #===============================================================================    
-from .exceptions import NotConnected, NonZeroReturnCode, Stderr
+from .exceptions import NotConnected, NonZeroReturnCode, Stderr, CommandTimedOut
 from .local      import LocalCommand
+from .core       import execute_many, CommandResult, raise_if_nonzero, raise_if_stderr
+from .pool       import pool
+from .breaker    import CircuitBreaker
 #===============================================================================    
-try:
-    import paramiko
-except ImportError:
-    print("Warning lrcmd:\n  Module paramiko is not available."
-           "\n  To allow for remote commands, either install paramiko, or"
-           "\n  actixvate a Python environment which has paramiko installed."
-          , file=sys.stderr
-          )
-    RemoteCommand = None
-else:
+# paramiko (and the cryptography modules it depends on) is only imported when
+# it is needed, i.e. when a Connection is made, so that local commands do not
+# pay for its import time.
+paramiko = None
+#===============================================================================    
+def _import_paramiko():
+    """
+    Import paramiko on first use.
+    """
+    global paramiko
+    if paramiko is None:
+        try:
+            import paramiko as _paramiko
+        except ImportError:
+            raise ImportError("lrcmd:\n  Module paramiko is not available."
+                              "\n  To allow for remote commands, either install paramiko, or"
+                              "\n  activate a Python environment which has paramiko installed."
+                             )
+        paramiko = _paramiko
+    return paramiko
+#===============================================================================    
+def _get_RemoteCommand():
+    """
+    Import class RemoteCommand (and hence paramiko) on first use.
+    """
     from lrcmd.remote import RemoteCommand
+    return RemoteCommand
+#===============================================================================    
+def __getattr__(name):
+    # keep lrcmd.RemoteCommand available, without importing it eagerly.
+    if name=='RemoteCommand':
+        return _get_RemoteCommand()
+    raise AttributeError(f"module 'lrcmd' has no attribute '{name}'")
 #===============================================================================
 def run( command, connection=None
                 , working_directory='.'
@@ -46,7 +71,10 @@ def run( command, connection=None
                 , post_processor=None
                 , attempts=1
                 , wait=0
+                , max_wait=30.0
+                , jitter=0.5
                 , verbose=True 
+                , session=None
                 ):
     """
     Wrapper function around LocalCommand (*connection=None*) and RemoteCommand 
@@ -72,15 +100,22 @@ def run( command, connection=None
     :param int attempts: number of times the command is retried on failure. 
     :param int wait: seconds of wait time after the first failure, doubled on 
         every failure.
+    :param float max_wait: upper bound for the wait time between two attempts.
+    :param float jitter: the wait time is multiplied by a random factor in 
+        [1-jitter,1+jitter], to avoid that commands failing together also retry
+        together.
+    :param session: for local commands a :class:`lrcmd.spawnpool.ShellPool`
+        in which the command is executed, rather than in a new subprocess. For
+        remote commands a :class:`lrcmd.remote.RemoteShell` on *connection*, 
+        in which the command is executed, rather than on a new ssh channel.
     
     :return: on success, an object containing returncode, stdout and stderr as 
         members.
       
     """
-    if connection is None:
-        cmd = LocalCommand(command,working_directory=working_directory)
-    else:
-        cmd = RemoteCommand(connection,command,working_directory=working_directory)
+    if connection is not None:
+        connection.ensure_alive()
+    cmd = _command(command,connection,working_directory,session)
     
     if attempts==1:
         result = cmd.execute( post_processor  = post_processor
@@ -92,6 +127,8 @@ def run( command, connection=None
     else:
         result = cmd.execute_repeat( attempts        = attempts
                                    , wait            = wait
+                                   , max_wait        = max_wait
+                                   , jitter          = jitter
                                    , post_processor  = post_processor
                                    , check           = check
                                    , stderr_is_error = stderr_is_error
@@ -101,8 +138,132 @@ def run( command, connection=None
                                    )
 
     return result
-    #---------------------------------------------------------------------------
+#===============================================================================
+async def run_async( command, connection=None
+                   , working_directory='.'
+                   , check=True
+                   , stderr_is_error=False
+                   , timeout=None
+                   , error_log=None
+                   , post_processor=None
+                   , attempts=1
+                   , wait=0
+                   , max_wait=30.0
+                   , jitter=0.5
+                   , verbose=True 
+                   , session=None
+                   ):
+    """
+    Coroutine version of :func:`run`, with the same parameters. The command is
+    executed by :func:`lrcmd.core.CommandBase.execute_async`, and the waiting 
+    between attempts does not block the event loop, so that other coroutines 
+    (e.g. other commands) proceed meanwhile::
+    
+        results = await asyncio.gather( run_async('hostname',connection=c1)
+                                      , run_async('hostname',connection=c2)
+                                      )
+    """
+    cmd = _command(command,connection,working_directory,session)
+    if connection is not None:
+        # may reconnect, which blocks
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(cmd._executor, connection.ensure_alive)
     
+    if attempts==1:
+        result = await cmd.execute_async( post_processor  = post_processor
+                                        , check           = check
+                                        , stderr_is_error = stderr_is_error
+                                        , timeout         = timeout
+                                        , error_log       = error_log
+                                        )
+    else:
+        result = await cmd.execute_repeat_async( attempts        = attempts
+                                               , wait            = wait
+                                               , max_wait        = max_wait
+                                               , jitter          = jitter
+                                               , post_processor  = post_processor
+                                               , check           = check
+                                               , stderr_is_error = stderr_is_error
+                                               , timeout         = timeout
+                                               , error_log       = error_log
+                                               , verbose         = verbose
+                                               )
+    return result
+#===============================================================================
+def _command(command,connection,working_directory,session):
+    """
+    Create the LocalCommand or RemoteCommand object for :func:`run` and 
+    :func:`run_async`.
+    """
+    if connection is None:
+        return LocalCommand(command,working_directory=working_directory,session=session)
+    return _get_RemoteCommand()( connection,command
+                               , working_directory=working_directory,session=session
+                               )
+#===============================================================================
+_SSH_DIR = os.path.expanduser('~/.ssh')
+_WINDOW_SIZE = 2**27
+# Rekey less often than paramiko's default (every 2**29 bytes or packets), 
+# but well before the 32 bit packet sequence number wraps around, and after 
+# at most 2**32 blocks of a 128 bit block cipher (RFC 4344).
+_REKEY_PACKETS = 2**31
+_REKEY_BYTES   = 2**36
+# Default options for OpenSSH clients (see Connection.ssh_args). The commands 
+# transfer little data: prefer the cheapest ciphers (AES-GCM is hardware 
+# accelerated on most CPUs, and needs no separate MAC), don't compress, and 
+# don't allocate a pseudo terminal (as ssh -T).
+_SSH_OPTIONS = { 'Ciphers'    : ','.join([ 'aes128-gcm@openssh.com'
+                                         , 'chacha20-poly1305@openssh.com'
+                                         , 'aes256-gcm@openssh.com'
+                                         , 'aes128-ctr'
+                                         , 'aes256-ctr'
+                                         ])
+               , 'MACs'       : 'hmac-sha2-256-etm@openssh.com,hmac-sha2-256,hmac-sha2-512'
+               , 'Compression': 'no'
+               , 'RequestTTY' : 'no'
+               }
+#===============================================================================
+def _resolve_key(ssh_key):
+    """
+    Return the expanded file path of ssh key *ssh_key*. If it does not contain 
+    a path separator, the key is assumed to be in '~/.ssh/'.
+    """
+    ssh_key = os.path.expanduser(ssh_key)
+    if not os.sep in ssh_key:
+        ssh_key = os.path.join(_SSH_DIR,ssh_key)
+    return ssh_key
+#===============================================================================
+def _prompt_credentials(login_node, username, ssh_key, passphrase, use_agent):
+    """
+    Ask the user for the credentials missing to connect to *login_node*.
+    
+    :return: *username*, *ssh_key* and *passphrase*.
+    :raise: *NotConnected* if the user ends the connection process.
+    """
+    echo(f"Interactively connecting to {login_node} ...", err=True) 
+    if username is None:
+        username = prompt("  Enter username")
+    while ssh_key is None and not use_agent:
+        ssh_key    = prompt(f"  Enter ssh key filename for user {username}"
+                           , default=''
+                           )
+        if not ssh_key:
+            raise NotConnected("You ended the connection process by not providing a ssh key.")
+        ssh_key = _resolve_key(ssh_key)
+        if not os.path.exists(ssh_key):
+            echo(f"Inexisting key: '{ssh_key}'. Try again.",err=True)
+            ssh_key = None
+
+    if not use_agent:
+        passphrase = prompt(f"  Passphrase for {ssh_key}"
+                           , default=''
+                           , hide_input=True
+                           , prompt_suffix=': '
+                           , show_default=True
+                           )
+    if not confirm(f"  Continue connecting {username}@{login_node} with key {ssh_key}?"):
+        raise NotConnected("Connection process ended intentionally.")
+    return username, ssh_key, passphrase
 #===============================================================================
 class Connection:
     """
@@ -123,74 +284,237 @@ class Connection:
     :param bool verbose: prints a message to stderr on successfull connection.
     :param str label: extra information added to self.label, which by default 
         contains *'username@login_node'* .
+    :param int keepalive_interval: seconds between keep-alive packets sent over
+        the connection, to prevent idle connections from being dropped.
+    :param int max_sessions: maximum number of channels (remote commands, 
+        sftp clients, remote shells) open simultaneously on this connection. 
+        Servers refuse to open more channels per connection than their 
+        *MaxSessions* setting (10 for OpenSSH).
+    :param bool use_agent: authenticate with the keys held by the running 
+        ssh-agent (``ssh-add``), rather than reading and decrypting *ssh_key*
+        for every new connection. No passphrase is needed, and *ssh_key* may
+        be *None*. 
+    :param dict ssh_options: OpenSSH options for :func:`ssh_args`, updating
+        the defaults (cipher and MAC preferences, no compression, no pseudo
+        terminal). An option with value *None* is removed.
     """
     #---------------------------------------------------------------------------    
     def __init__( self, login_node
                 , username=None, ssh_key=None, passphrase=None
                 , verbose=False
                 , label=None
+                , keepalive_interval=30
+                , max_sessions=10
+                , use_agent=False
+                , ssh_options=None
                 ):
         """
         Open a connection
         """
-        if username is None or ssh_key is None:
-            echo(f"Interactively connecting to {login_node} ...", err=True) 
-            if username is None:
-                username = prompt("  Enter username")
-            while ssh_key is None:
-                ssh_key    = prompt(f"  Enter ssh key filename for user {username}"
-                                   , default=''
-                                   )
-                if not ssh_key:
-                    raise NotConnected("You ended the connection process by not providing a ssh key.")
-                ssh_key = os.path.expanduser(ssh_key)
-                if not os.sep in ssh_key:
-                    ssh_key = os.path.expanduser(os.path.join('~/.ssh',ssh_key))
-                if not os.path.exists(ssh_key):
-                    echo(f"Inexisting key: '{ssh_key}'. Try again.",err=True)
-                    ssh_key = None
-
-            passphrase = prompt(f"  Passphrase for {ssh_key}"
-                               , default=''
-                               , hide_input=True
-                               , prompt_suffix=': '
-                               , show_default=True
-                               )
-            if not confirm(f"  Continue connecting {username}@{login_node} with key {ssh_key}?"):
-                raise NotConnected("Connection process ended intentionally.")
+        _import_paramiko()
+        if ssh_key is not None:
+            ssh_key = _resolve_key(ssh_key)
+        if username is None or (ssh_key is None and not use_agent):
+            username, ssh_key, passphrase = _prompt_credentials( login_node, username, ssh_key
+                                                               , passphrase, use_agent
+                                                               )
             verbose = True
              
         self.login_node = login_node
         self.username   = username
 
-        self.ssh_key = ssh_key
-        if not os.sep in self.ssh_key:
-            self.ssh_key = os.path.expanduser(os.path.join('~/.ssh',ssh_key))
+        self.ssh_key    = ssh_key
+        self.use_agent  = use_agent
+        self.ssh_options = dict(_SSH_OPTIONS)
+        self.ssh_options.update(ssh_options or {})
+        # kept, so that we can reconnect without prompting the user again.
+        self._passphrase = passphrase
+        self.keepalive_interval = keepalive_interval
         
         self.label = f"{username}@{login_node}"
         if label:
             self.label+=f' ({label})'
         
         self.paramiko_client = None
+        self._sftp = None
+        self._programs = {}
+        self._max_sessions = max_sessions
+        self._sessions = threading.BoundedSemaphore(max_sessions)
+        # fail fast, rather than waiting for network timeouts, when the remote
+        # machine is down.
+        self._breaker = CircuitBreaker(fail_threshold=5, reset_timeout=30)
+        self._connect()
+        if verbose:
+            echo(f"Successfully connected: {self.label} (key='{self.ssh_key}').", err=True)
+    #---------------------------------------------------------------------------    
+    def _connect(self):
+        """
+        Obtain a connected paramiko client from the connection pool.
+        
+        :raise: *NotConnected* if the connection could not be established.
+        """
+        self.paramiko_client = pool.acquire(self._pool_key(), self._new_paramiko_client)
+    #---------------------------------------------------------------------------    
+    def _pool_key(self):
+        return (self.login_node, self.username, self.ssh_key, self.use_agent)
+    #---------------------------------------------------------------------------    
+    def _new_paramiko_client(self):
+        """
+        Open a new paramiko client, and enable keep-alive packets on its 
+        transport, so that idle connections are not dropped by firewalls or NAT
+        gateways. The transport is tuned for large file transfers.
+        
+        :raise: *NotConnected* if the connection could not be established.
+        """
         try:
-            self.paramiko_client = paramiko.client.SSHClient()
-            self.paramiko_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            if passphrase:
-                self.paramiko_client.connect( hostname     = login_node
-                                            , username     = username
-                                            , key_filename = self.ssh_key
-                                            , passphrase   = passphrase
-                                            )
+            client = paramiko.client.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            if self.use_agent:
+                # only the agent's keys, no key files are read.
+                client.connect( hostname     = self.login_node
+                              , username     = self.username
+                              , allow_agent  = True
+                              , look_for_keys= False
+                              )
+            elif self._passphrase:
+                client.connect( hostname     = self.login_node
+                              , username     = self.username
+                              , key_filename = self.ssh_key
+                              , passphrase   = self._passphrase
+                              )
             else:
-                self.paramiko_client.connect( hostname     = login_node
-                                            , username     = username
-                                            , key_filename = self.ssh_key
-                                            )
-            if verbose:
-                echo(f"Successfully connected: {self.label} (key='{self.ssh_key}').", err=True)
-        except:
+                client.connect( hostname     = self.login_node
+                              , username     = self.username
+                              , key_filename = self.ssh_key
+                              )
+            transport = client.get_transport()
+            transport.set_keepalive(self.keepalive_interval or 30)
+            # paramiko's default flow control window throttles transfers over
+            # high-latency links. Use a large window for all channels, and
+            # avoid rekeying in the middle of large transfers.
+            transport.default_window_size = _WINDOW_SIZE
+            transport.packetizer.REKEY_BYTES   = _REKEY_BYTES
+            transport.packetizer.REKEY_PACKETS = _REKEY_PACKETS
+            # Disable Nagle's algorithm, as OpenSSH does: otherwise a short 
+            # command sent right after another small packet (e.g. the probe 
+            # in ensure_alive) waits for a delayed ACK (~40 ms).
+            if isinstance(transport.sock, socket.socket):
+                transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except Exception:
             raise NotConnected(f"Failed to connect {self.label} (key='{self.ssh_key}').")
+        return client
+    #---------------------------------------------------------------------------    
+    def _reconnect(self):
+        """
+        Discard the current paramiko client (if any) and connect again, using 
+        the login information provided on construction.
+        """
+        if self.paramiko_client is not None:
+            self.paramiko_client.close()
             self.paramiko_client = None
+        if self._sftp is not None:
+            # its channel died with the old client
+            self._sftp = None
+            self._release_session()
+        self._programs = {}
+        self._connect()
+    #---------------------------------------------------------------------------    
+    def close(self):
+        """
+        Close the connection. The underlying paramiko client is given back to 
+        the connection pool, so that a new Connection to the same remote machine
+        can reuse it.
+        """
+        if self._sftp is not None:
+            self._close_sftp(self._sftp)
+            self._sftp = None
+        if self.paramiko_client is not None:
+            pool.release(self._pool_key(), self.paramiko_client)
+            self.paramiko_client = None
+    #---------------------------------------------------------------------------    
+    def sftp(self):
+        """
+        Return the sftp client of this connection. It is opened on first use and 
+        kept open for subsequent file transfers, until the connection is closed.
+        
+        :rtype: paramiko.SFTPClient
+        """
+        if self._sftp is None:
+            self._sftp = self._open_sftp()
+        return self._sftp
+    #---------------------------------------------------------------------------    
+    def _acquire_session(self, timeout=None):
+        """
+        Reserve one of the *max_sessions* channels of this connection. Every 
+        channel opened on the connection must hold one, and give it back with
+        :func:`_release_session` when it is closed.
+        
+        :raise: *CommandTimedOut* if no channel became available within 
+            *timeout* seconds.
+        """
+        if not self._sessions.acquire(timeout=timeout):
+            raise CommandTimedOut(f"No channel available on {self.label} within {timeout}s"
+                                  f" (max_sessions={self._max_sessions} reached).")
+    #---------------------------------------------------------------------------    
+    def _release_session(self):
+        self._sessions.release()
+    #---------------------------------------------------------------------------    
+    def _open_sftp(self, timeout=None):
+        """
+        Open a new sftp client, on a channel of its own. Close it with 
+        :func:`_close_sftp`.
+        
+        :rtype: paramiko.SFTPClient
+        """
+        self._acquire_session(timeout)
+        try:
+            return self.paramiko_client.open_sftp()
+        except BaseException:
+            self._release_session()
+            raise
+    #---------------------------------------------------------------------------    
+    def _close_sftp(self, sftp):
+        try:
+            sftp.close()
+        finally:
+            self._release_session()
+    #---------------------------------------------------------------------------    
+    def has_program(self, program):
+        """
+        Test if *program* is available on the remote machine. The answer is
+        cached, so that only the first test for *program* costs a round trip.
+        
+        :rtype: bool
+        """
+        if program not in self._programs:
+            result = run(f"command -v {shlex.quote(program)} || true", self)
+            self._programs[program] = bool(result.stdout.strip())
+        return self._programs[program]
+    #---------------------------------------------------------------------------    
+    def ensure_alive(self):
+        """
+        Verify that the connection is still alive by sending an ignore message
+        over the transport, and reconnect if it is not.
+        
+        :raise: *NotConnected* if reconnecting failed, or if reconnecting failed
+            too often recently (see :class:`lrcmd.breaker.CircuitBreaker`).
+        """
+        transport = None
+        if self.paramiko_client is not None:
+            transport = self.paramiko_client.get_transport()
+        try:
+            if transport is None or not transport.is_active():
+                raise EOFError
+            transport.send_ignore()
+        except (EOFError, socket.error, paramiko.SSHException):
+            if not self._breaker.allow():
+                raise NotConnected(f"Not reconnecting {self.label}: too many consecutive failures.")
+            try:
+                self._reconnect()
+            except NotConnected:
+                self._breaker.on_failure()
+                raise
+            self._breaker.on_success()
     #---------------------------------------------------------------------------    
     def is_connected(self):
         """
@@ -200,5 +524,41 @@ class Connection:
         """
         return not self.paramiko_client is None
     #---------------------------------------------------------------------------    
+    def ssh_args(self, control_persist='5m'):
+        """
+        Command line options for OpenSSH clients (ssh, scp, sftp, 
+        ``rsync -e``, ...) connecting to the same remote machine as this 
+        Connection, with the options of *ssh_options*. 
+        
+        The first invocation opens a master connection which is kept open for
+        *control_persist* after the last invocation, and which is shared by all
+        later invocations (OpenSSH's ControlMaster), so that these do not repeat
+        the ssh handshake and authentication. (Commands executed by lrcmd 
+        itself already share the paramiko connection.)
+        
+        If the Connection *use_agent*, the OpenSSH clients authenticate with
+        the ssh-agent too, offering only *ssh_key* if it is specified.
+        
+        :return: list of str. The destination ``username@login_node`` is not 
+            included.
+        """
+        args = [ '-o', 'ControlMaster=auto'
+               , '-o', f'ControlPath={os.path.join(_SSH_DIR,"lrcmd-%C")}'
+               , '-o', f'ControlPersist={control_persist}'
+               ]
+        if self.use_agent:
+            args.extend(['-o', 'IdentityAgent=SSH_AUTH_SOCK'])
+            if self.ssh_key:
+                args.extend(['-o', 'IdentitiesOnly=yes'])
+        for option,value in self.ssh_options.items():
+            if value is not None:
+                args.extend(['-o', f'{option}={value}'])
+        if self.ssh_key:
+            args.extend(['-i', self.ssh_key])
+        if self.username:
+            # not '-l', which means something else to scp
+            args.extend(['-o', f'User={self.username}'])
+        return args
+    #---------------------------------------------------------------------------    
 
 #===============================================================================
@@ -0,0 +1,87 @@
+"""
+Class CircuitBreaker
+====================
+A circuit breaker prevents that every command sent to a remote machine that is
+down has to wait for a network timeout before it fails.
+"""
+#===============================================================================
+import threading
+from time import monotonic
+#===============================================================================
+class CircuitBreaker:
+    """
+    After *fail_threshold* consecutive failures the breaker *opens*:
+    :func:`allow` returns False, so that callers can fail immediately. After
+    *reset_timeout* seconds the breaker is *half-open*: a single call is allowed
+    to probe the remote machine. If it succeeds, the breaker *closes* again,
+    otherwise it stays open for another *reset_timeout* seconds.
+
+    :param int fail_threshold: number of consecutive failures that opens the
+        breaker.
+    :param float reset_timeout: seconds before an open breaker allows a probe.
+    """
+    #---------------------------------------------------------------------------
+    def __init__(self, fail_threshold=5, reset_timeout=30):
+        self.fail_threshold = fail_threshold
+        self.reset_timeout  = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+    #---------------------------------------------------------------------------
+    @property
+    def state(self):
+        """
+        One of *'closed'*, *'open'* or *'half-open'*.
+        """
+        if self._opened_at is None:
+            return 'closed'
+        if self._probing or monotonic() - self._opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+    #---------------------------------------------------------------------------
+    def allow(self):
+        """
+        Test if a call may be attempted.
+
+        :rtype: bool
+        """
+        with self._lock:
+            state = self.state
+            if state == 'half-open':
+                self._probing = True
+                return True
+            return state == 'closed'
+    #---------------------------------------------------------------------------
+    def on_success(self):
+        """
+        Report a successful call. This closes the breaker.
+        """
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._probing = False
+    #---------------------------------------------------------------------------
+    def on_failure(self):
+        """
+        Report a failed call. This opens the breaker if the failure threshold
+        is reached, or if the call was the probe of a half-open breaker.
+        """
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.fail_threshold:
+                self._opened_at = monotonic()
+                self._probing = False
+    #---------------------------------------------------------------------------
+    def on_cancel(self):
+        """
+        Report a call that was interrupted before its outcome was known (e.g. 
+        by KeyboardInterrupt). If it was the probe of a half-open breaker, the
+        next call may probe again, otherwise the breaker would stay open for 
+        ever.
+        """
+        with self._lock:
+            self._probing = False
+    #---------------------------------------------------------------------------
+
+#===============================================================================
@@ -8,18 +8,85 @@ All commands take an optional *connection* parameter, which, if equalling *None*
 has the command executed locally, and remotely otherwise.
 """
 #===============================================================================    
-import os,errno,shutil,fnmatch
+import os,errno,shutil,shlex,socket,subprocess,pathlib,stat,queue
+import concurrent.futures,contextlib
 #===============================================================================    
 from lrcmd import run
-try:
-    from lrcmd.remote import RemoteCommand
-except ModuleNotFoundError:
-    RemoteCommand = None
-from lrcmd.postprocessors import list_of_lines
-from lrcmd.exceptions import NonZeroReturnCode, CommandTimedOut
+from lrcmd.postprocessors import list_of_non_empty_lines
+from lrcmd.exceptions import NonZeroReturnCode, CommandTimedOut, RemoteError
 from execution_trace import trace
 from click           import echo
 #===============================================================================
+# pigz is a parallel implementation of gzip.
+_LOCAL_PIGZ = shutil.which('pigz') is not None
+#===============================================================================
+# file test operators that can be evaluated locally without a subprocess
+_LOCAL_FILE_TESTS = { '-e': os.path.exists
+                    , '-d': os.path.isdir
+                    , '-f': os.path.isfile
+                    , '-L': os.path.islink
+                    , '-h': os.path.islink
+                    , '-r': lambda p: os.access(p, os.R_OK)
+                    , '-w': lambda p: os.access(p, os.W_OK)
+                    , '-x': lambda p: os.access(p, os.X_OK)
+                    , '-s': lambda p: os.path.exists(p) and os.path.getsize(p) > 0
+                    }
+# file test operators that can be evaluated from the st_mode of a sftp stat call
+_SFTP_FILE_TESTS = { '-e': lambda mode: True
+                   , '-d': stat.S_ISDIR
+                   , '-f': stat.S_ISREG
+                   }
+#===============================================================================
+# Cache for the results of remote exists() calls, keyed by 
+# (connection, normalized path, operator). None if caching is disabled.
+_exists_cache = None
+#===============================================================================
+@contextlib.contextmanager
+def exists_cache():
+    """
+    Context manager that caches the results of remote :func:`exists` calls, so
+    that testing the same path again does not cost another round trip to the 
+    remote machine. E.g.::
+    
+        with exists_cache():
+            if not exists(p,connection):   # remote test
+                ensure_dir(p,connection)   # forgets p
+            assert exists(p,connection)    # remote test
+            assert exists(p,connection)    # cached
+    
+    The cached results for a path (and for its parents and children) are 
+    forgotten when the path is changed by :func:`ensure_dir`, :func:`remove`, 
+    :func:`touch`, :func:`rename` or one of the copy commands of this module. 
+    Changes made otherwise, e.g. by :func:`lrcmd.run` or by other processes, 
+    go unnoticed. Use it only where that is not an issue.
+    
+    Local exists() calls are not cached, they do not need a subprocess.
+    """
+    global _exists_cache
+    previous = _exists_cache
+    _exists_cache = {}
+    try:
+        yield
+    finally:
+        _exists_cache = previous
+#===============================================================================
+def _forget(connection, *paths):
+    """
+    Remove the cached exists() results on *connection* for *paths*, their 
+    parents and their children.
+    """
+    if not _exists_cache:
+        return
+    paths = [os.path.normpath(p) for p in paths]
+    
+    def related(q):
+        for p in paths:
+            if q == p or q.startswith(p+'/') or p.startswith(q+'/'):
+                return True
+        return False
+    for key in [key for key in _exists_cache if key[0] is connection and related(key[1])]:
+        del _exists_cache[key]
+#===============================================================================
 def exists(p, connection=None, operator=None):
     """
     Test if a path *p* to a file or directory exists locally (*connection=None*) 
@@ -31,32 +98,55 @@ def exists(p, connection=None, operator=None):
     :param str operator: one of the 
         `bash file test operators <https://www.tldp.org/LDP/abs/html/fto.html>`_ 
         that will be used to execute the test. E.g. *operator='-x'* test if *p* 
-        is executable.
+        is executable. Default is '-e'.
     :rtype: bool
+    
+    Locally, the common operators are evaluated with the Python standard 
+    library. Remotely, the operators '-e', '-d' and '-f' are evaluated with a 
+    stat call over the connection's sftp channel, rather than by running a 
+    command in a remote shell. Remote results can be cached, see 
+    :func:`exists_cache`.
     """
-    if operator is None:
-        if connection is None:
-            return os.path.exists(p)
-        else:
-            cmd = f"[ -e {p} ]"
-            try:
-                run(cmd,connection) # may raise NotConnected
-                return True
-            except NonZeroReturnCode:
-                return False
-    else:
-        cmd = f"[ {operator} {p} ]"
+    op = operator or '-e'
+    if connection is None or _exists_cache is None:
+        return _exists(p, connection, op)
+    key = (connection, os.path.normpath(p), op)
+    result = _exists_cache.get(key)
+    if result is None:
+        result = _exists_cache[key] = _exists(p, connection, op)
+    return result
+#===============================================================================
+def _exists(p, connection, op):
+    """
+    Uncached implementation of :func:`exists`.
+    """
+    if connection is None:
+        test = _LOCAL_FILE_TESTS.get(op)
+        if test is not None:
+            return test(p)
+    elif op in _SFTP_FILE_TESTS:
+        connection.ensure_alive() # may raise NotConnected
         try:
-            run(cmd,connection) # may raise NotConnected
-            return True
-        except NonZeroReturnCode:
+            mode = connection.sftp().stat(p).st_mode
+        except IOError:
             return False
+        return _SFTP_FILE_TESTS[op](mode)
+    
+    cmd = f"[ {op} {shlex.quote(p)} ]"
+    try:
+        run(cmd,connection) # may raise NotConnected
+        return True
+    except NonZeroReturnCode:
+        return False
 #===============================================================================
 def ensure_dir(p,connection=None):
     """
     Create a directory path *p*, if it does not already exist, and return it. 
     
-    :param str p: the directory path that must be ensured.
+    :param str p: the directory path that must be ensured. Remote paths are 
+        taken literally: they are not subject to shell expansion (e.g. of 
+        '~', '$HOME' or wildcards). Relative remote paths are relative to the
+        remote home directory.
     :param Connection connection: if None, the command acts locally, 
         otherwise it is remotely as specified by *connection*.
     :return: *p*
@@ -73,12 +163,15 @@ def ensure_dir(p,connection=None):
                 raise
     else:
         #remote version
-        cmd = 'mkdir -p '+p
+        _forget(connection, p)
+        cmd = 'mkdir -p '+shlex.quote(p)
         run(cmd,connection) 
         # may raise NotConnected
         # no error if the path already exists. 
     return p
 #===============================================================================
+_RMTREE_MAX_ENTRIES = 1024
+#===============================================================================
 def remove(p,connection=None):
     """
     Remove a file or a directory (with its contents if non-empty).
@@ -90,10 +183,18 @@ def remove(p,connection=None):
     """
     if connection is None:
         # local remove
-        shutil.rmtree(p)
+        if not os.path.isdir(p) or os.path.islink(p):
+            os.remove(p)
+        elif len(os.listdir(p)) > _RMTREE_MAX_ENTRIES:
+            # for large directories a single rm -rf is much faster than 
+            # shutil.rmtree, which removes the entries one by one from Python.
+            run(f"rm -rf {shlex.quote(p)}")
+        else:
+            shutil.rmtree(p)
     else:
         # remote remove
-        cmd = 'rm -rf '+p
+        _forget(connection, p)
+        cmd = 'rm -rf '+shlex.quote(p)
         run(cmd,connection)
 #===============================================================================    
 def touch(file,path='.',connection=None):
@@ -106,9 +207,16 @@ def touch(file,path='.',connection=None):
     :param Connection connection: if None, the command acts locally, 
         otherwise it is remotely as specified by *connection*.
     """
-    ensure_dir(path, connection=connection)
-    cmd = "touch "+os.path.join(path,file)
-    run(cmd,connection=connection)
+    p = os.path.join(path,file)
+    if connection is None:
+        # local touch
+        os.makedirs(path, exist_ok=True)
+        pathlib.Path(p).touch()
+    else:
+        # remote touch, in a single round trip
+        _forget(connection, p)
+        cmd = f"mkdir -p {shlex.quote(path)} && touch {shlex.quote(p)}"
+        run(cmd,connection=connection)
 #===============================================================================    
 def glob(pattern,path='.',connection=None):
     """
@@ -123,21 +231,19 @@ def glob(pattern,path='.',connection=None):
         otherwise it is remotely as specified by *connection*.
     :return: a *list* of all filenames that match *pattern* in directory *path*.
     """
-    cmd = f"find {path} -maxdepth 1 -type f"
-    files = run(cmd,connection=connection,post_processor=list_of_lines).processed
-    result =[]
-    for file in files:
-        filename = os.path.basename(file)
-        if fnmatch.fnmatch(filename,pattern):
-            result.append(filename)
-    return result
+    # let find filter the filenames, rather than transferring all of them.
+    # (find -name supports the same wildcards as fnmatch)
+    cmd = f"find {shlex.quote(path)} -maxdepth 1 -type f -name {shlex.quote(pattern)}"
+    files = run(cmd,connection=connection,post_processor=list_of_non_empty_lines).processed
+    return [os.path.basename(file) for file in files]
 #===============================================================================    
 def rename(src,dst,connection=None):
     """
     Rename a directory or file.
     
     :param str src: path to directory or file to be renamed
-    :param str dst: new path
+    :param str dst: new path. Remote paths *src* and *dst* are taken literally,
+        as in :func:`ensure_dir`.
     :param Connection connection: if None, the command acts locally, 
         otherwise it is remotely as specified by *connection*.
     """
@@ -146,7 +252,8 @@ def rename(src,dst,connection=None):
         os.rename(src,dst)
     else:
         # remote rename
-        cmd = f'mv {src} {dst}'
+        _forget(connection, src, dst)
+        cmd = f'mv {shlex.quote(src)} {shlex.quote(dst)}'
         run(cmd,connection)
 #===============================================================================
 def env(var,connection=None):
@@ -160,20 +267,15 @@ def env(var,connection=None):
         empty str is returned (no KeyError is raised).
         
     """
+    var = var.lstrip('$')
     if connection is None:
-        if var[0]=='$':
-            var = var[1:]
-        try:
-            val = os.environ[var]
-        except KeyError:
-            val = ''
+        val = os.environ.get(var,'')
     else:
-        if var[0]=='$':
-            cmd = 'echo '+var
-        else:
-            cmd = 'echo $'+var
+        # printenv does not need the shell to expand the variable, and 
+        # prints nothing if it does not exist.
+        cmd = f"printenv {shlex.quote(var)} || true"
         result = run(cmd,connection)
-        val = result.stdout[:-1]
+        val = result.stdout.rstrip('\n')
     return val
 #===============================================================================
 def copy_local_to_remote(connection,local_source,remote_destination
@@ -181,79 +283,105 @@ def copy_local_to_remote(connection,local_source,remote_destination
                         ):
     """
     Copy a local file or directory to a remote file or directory. If local_source
-    refers to a directory, it is tarred, copied, and untarred. Finally, the .tar
-    files are removed. 
+    refers to a directory, it is tarred and streamed over the connection to a 
+    remote tar command which extracts it on the fly. No intermediate .tar files
+    are created.
     
     :param Connection connection:
     :param str local_source: path to the local file.
     :param str remote_destination: path to remote file (filename must be included). 
-    :param int timeout: timeout for the compression command in seconds.
+    :param int timeout: timeout in seconds for the transfer of a directory. It 
+        applies to every individual read or write of the transfer.
+    :raise: *RemoteError* if the remote tar command fails, *NonZeroReturnCode*
+        if the local one fails, *CommandTimedOut* on a timeout.
     
     **Warning** : Make sure that during login nothing writes to stdout. That will 
     mess up the sftp protocol.
     """
     assert(os.path.exists(local_source))
+    _forget(connection, remote_destination)
 
     if os.path.isdir(local_source):
-        # copy whole directory, by first compressing it, copying the compressed file,
-        # and decompressing it at the remote location. If successfull, the compressed
-        # files are removed.
-        
-        # split local path in parent and directory:
-        if local_source.endswith('/'): # remove trailing '/'
-            local_source = local_source[:-2]
-        local_parent,local_dir = os.path.split(local_source)
-        
-        # split remote path in parent and directory:
-        if remote_destination.endswith('/'): # remove trailing '/'
-            remote_destination = remote_destination[:-2]
-        remote_parent,remote_dir = os.path.split(remote_destination)
+        # remove trailing '/'
+        local_source = local_source.rstrip('/')
+        remote_destination = remote_destination.rstrip('/')
+        remote_parent = os.path.dirname(remote_destination)
         
         #verify that the remote parent exists:
         assert exists(remote_parent, connection), f"Inexisting remote path: '{remote_parent}'"
         
-        # compress the directory:
-        # don't use verbose option (v), it write to stderr and hence raises a Stderr exception 
-        with trace(f'compressing "{local_dir}"'):
-            cmd = f'tar -zcf {local_dir}.tar.gz {local_dir}'
+        # stream the compressed directory to a remote tar process, as in
+        #   tar -C local_source -czf - . | ssh ... tar -C remote_destination -xzf -
+        # pigz is used for (de)compression where it is available.
+        # don't use verbose option (v), it writes to stderr.
+        with trace(f'Copying "{local_source}"'):
+            remote_pigz = connection.has_program('pigz')
+            remote_decompress = '--use-compress-program=pigz' if remote_pigz else '-z'
+            remote_cmd = f'mkdir -p {shlex.quote(remote_destination)} && ' \
+                         f'tar -C {shlex.quote(remote_destination)} {remote_decompress} -xf -'
+            local_compress = '--use-compress-program=pigz' if _LOCAL_PIGZ else '-z'
+            local_cmd = ['tar','-C',local_source,local_compress,'-cf','-','.']
+            # imported here, so that lrcmd.commands does not import paramiko.
+            from lrcmd.remote import _tar_to_remote
             try:
-                run(cmd,working_directory=local_parent,timeout=timeout)
-            except CommandTimedOut:
-                raise Exception('\nThe command'
-                               f'\n  {cmd}'
-                               f'\nfailed to complete in {timeout} s.'
-                                '\nLarge files may take a substantial amount of time to compress.'
-                                '\nTry increasing the timeout parameter.'
-                               )
-            local_source_compressed = f'{local_source}.tar.gz'
-            # verify that the compressed file exists:
-            assert(os.path.exists(local_source_compressed))
-        
-        # copy the compressed file:
-        with trace(f'Copying "{local_dir}"'):
-            remote_destination_compressed = f'{remote_destination}.tar.gz'
-            copy_local_to_remote(connection,local_source_compressed,remote_destination_compressed)
-            # verify that the copy exists:
-            cmd = f'ls {remote_destination_compressed}'
-            run(cmd,connection) # raises Stderr if the copy is not there
-        
-        # extract the archive
-        with trace(f"Extracting '{local_dir}'"):
-            cmd = f'tar -zxvf {remote_dir}.tar.gz {remote_dir}'
-            run(cmd,connection,working_directory=remote_parent)
-        
-        # clean up the local and remote tar files
-        with trace('Cleaning up'):
-            os.remove(f'{local_source}.tar.gz')
-            cmd = f'rm {remote_destination}.tar.gz'
-            run(cmd,connection)
+                result, remote_result = _tar_to_remote(connection, local_cmd, remote_cmd, timeout)
+            except socket.timeout:
+                raise CommandTimedOut('\nCopying'
+                                     f'\n  {local_source}'
+                                     f'\nfailed to complete in {timeout} s.'
+                                      '\nLarge directories may take a substantial amount of time'
+                                      ' to copy.'
+                                      '\nTry increasing the timeout parameter.'
+                                     )
+            
+            if result.returncode!=0:
+                msg = f"\n  Local command '{' '.join(local_cmd)}'" \
+                      f"\n  yields nonzero exit code: {result.returncode}" \
+                      f"\n  stderr: {result.stderr}"
+                raise NonZeroReturnCode(msg, result=result)
+            if remote_result.returncode!=0:
+                msg = f"\n  Remote command '{remote_cmd}'" \
+                      f"\n  yields nonzero exit code: {remote_result.returncode}" \
+                      f"\n  stderr: {remote_result.stderr}"
+                raise RemoteError(msg, result=remote_result)
             
         echo(f'copied "{local_source}" to "{remote_destination}"', err=True)
     else:
-        sftp = connection.paramiko_client.open_sftp()
+        sftp = connection.sftp()
         sftp.put(local_source, remote_destination)
         #   disk quota exceeded may cause this to fail...
-        sftp.close()
+#===============================================================================
+def rsync_local_to_remote(connection,local_source,remote_destination
+                         ,chmod=None
+                         ,timeout=None
+                         ):
+    """
+    Copy a local file or directory to a remote file or directory with rsync, 
+    which only transfers what has changed. 
+    
+    rsync runs over OpenSSH, with the options of :func:`Connection.ssh_args`, 
+    so that successive calls share a single ssh master connection. rsync must 
+    be installed locally and remotely.
+    
+    :param Connection connection:
+    :param str local_source: path to the local file or directory. As with 
+        rsync, a trailing '/' copies the contents of a directory, rather than 
+        the directory itself.
+    :param str remote_destination: path to the remote file or directory. 
+    :param str chmod: permissions to apply to the copied files, as in rsync's
+        ``--chmod`` option, e.g. *'u+x'*. This saves a separate remote 
+        ``chmod`` command.
+    :param int timeout: seconds in which the transfer must complete.
+    :raise: *NonZeroReturnCode* if rsync fails.
+    """
+    assert(os.path.exists(local_source))
+    _forget(connection, remote_destination)
+    ssh = ' '.join(shlex.quote(arg) for arg in ['ssh',*connection.ssh_args()])
+    args = ['rsync','-a','-e',ssh]
+    if chmod:
+        args.append(f'--chmod={chmod}')
+    args.extend([local_source, f'{connection.login_node}:{remote_destination}'])
+    run(' '.join(shlex.quote(arg) for arg in args), timeout=timeout)
 #===============================================================================
 def copy_remote_to_local(connection,local_destination,remote_source,rename=False):
     """
@@ -268,28 +396,50 @@ def copy_remote_to_local(connection,local_destination,remote_source,rename=False
         If *rename==False*, the original file is just kept, as is. If *rename*
         is the empty string, the original file is removed, and if *rename* is 
         a non-empty string, thatwill be the name (and location, as in the linux
-        *mv* command) of the file after it is copied.
+        *mv* command) of the file after it is copied. Remote paths are taken
+        literally, as in :func:`ensure_dir`.
     """
-    sftp = connection.paramiko_client.open_sftp()
+    sftp = connection.sftp()
     sftp.get(remote_source,local_destination)
-    sftp.close()
     
     if isinstance(rename,str):
+        _forget(connection, remote_source, *([rename] if rename else []))
         if rename:
-            command = f'mv {remote_source} {rename}'
+            command = f'mv {shlex.quote(remote_source)} {shlex.quote(rename)}'
         else:
-            command = 'rm -f '+remote_source
-        cmd = RemoteCommand(connection,command)
-        cmd.execute()
+            command = 'rm -f '+shlex.quote(remote_source)
+        run(command,connection)
     else:
         if not (isinstance(rename,bool) and rename==False):
             raise ValueError(f"kwarg 'rename' must be str or False, got '{rename}'.")
 #===============================================================================
+_BATCH_SIZE = 1000
+#===============================================================================
+def _run_batched(command, paths, connection, target=None):
+    """
+    Run *command* remotely on all *paths* using as few remote commands as 
+    possible. The paths are passed in batches of *_BATCH_SIZE* to stay well
+    below the maximum command line length.
+    
+    :param str command: command to be applied to the paths, e.g. 'rm -f'.
+    :param list paths: list of (remote) paths.
+    :param Connection connection: a Connection object to a remote machine.
+    :param str target: optional last argument, e.g. the destination directory
+        of a *mv* command. 
+    """
+    for i in range(0, len(paths), _BATCH_SIZE):
+        cmd = command + ' ' + ' '.join(shlex.quote(p) for p in paths[i:i+_BATCH_SIZE])
+        if target:
+            cmd += ' ' + shlex.quote(target)
+        run(cmd,connection)
+#===============================================================================
 def copy_glob_remote_to_local(connection
                              ,local_destination,remote_source
                              ,pattern='*'
                              ,force_overwrite=False
                              ,verbosity=0
+                             ,rename=False
+                             ,max_channels=8
                              ):
     """
     Copy all remote files in *remote_source* matching *pattern* to 
@@ -301,31 +451,113 @@ def copy_glob_remote_to_local(connection
     :param str pattern: glob pattern to select the files that will be copied
     :param bool force_overwrite: overwrite any existing files in the local destination directory
     :param int verbosity: 0=silent, 1, 2
+    :param str rename: either *False*, '' (empty string) or non-empty string.
+        If *rename==False*, the remote files are kept, as is. If *rename* is the
+        empty string, the remote files that were copied are removed, and if 
+        *rename* is a non-empty string, it is the remote directory to which the 
+        copied files are moved. Files are removed or moved in batches, rather 
+        than one remote command per file.
+    :param int max_channels: maximum number of sftp channels used to copy files
+        concurrently.
+    :raise: *IOError* listing the files that could not be copied, after all 
+        other files were copied (and removed or moved, if requested).
     """
-    files = glob(connection, pattern, remote_source)
-    ensure_dir(local_destination)
-    copied = 0
-    not_copied = 0
+    if not isinstance(rename,str) and not (isinstance(rename,bool) and rename==False):
+        raise ValueError(f"kwarg 'rename' must be str or False, got '{rename}'.")
+    os.makedirs(local_destination, exist_ok=True)
     if verbosity==1:
         echo('> Copying from ' + remote_source    , err=True)
         echo('>           to ' + local_destination, err=True)
-    for file in files:
-        local_destination_file = os.path.join(local_destination,file)
-        remote_source_file     = os.path.join(remote_source    ,file)
-        if force_overwrite or not os.path.exists(local_destination_file):
-            if verbosity>0:
-                echo('>      copying ' + file)
-                if verbosity>1:
-                    echo('>    from ' + remote_source    , err=True)
-                    echo('>      to ' + local_destination, err=True)
-            copy_remote_to_local(connection,local_destination_file,remote_source_file)
-            copied += 1
+    todo, not_copied = _files_to_copy( connection, local_destination, remote_source
+                                     , pattern, force_overwrite, verbosity
+                                     )
+    copied, failed = _download(connection, local_destination, remote_source, todo, max_channels)
+    
+    if isinstance(rename,str) and copied:
+        _forget(connection, remote_source, *([rename] if rename else []))
+        if rename:
+            _run_batched('mv', copied, connection, target=rename)
         else:
-            not_copied += 1
+            _run_batched('rm -f', copied, connection)
     if verbosity>0:
-        echo(f'> {copied} files copied')
+        echo(f'> {len(copied)} files copied')
         if not force_overwrite:
             echo(f'> {not_copied} files not copied')
             if verbosity>1:
-                echo('> If you want to overwrite pre-existing files, specify force_overwrite=True.', err=True)            
+                echo('> If you want to overwrite pre-existing files, specify force_overwrite=True.'
+                    , err=True
+                    )
+    if failed:
+        msg = "\n  ".join([f"Failed to copy {len(failed)} files from {remote_source}:", *failed])
+        raise IOError(msg)
+#===============================================================================
+def _files_to_copy( connection, local_destination, remote_source
+                  , pattern, force_overwrite, verbosity
+                  ):
+    """
+    List the remote files in *remote_source* matching *pattern*, and select 
+    those that must be copied to *local_destination*. 
+    
+    :return: the list of files to copy, and the number of files skipped 
+        because they exist locally.
+    """
+    files = glob(pattern=pattern, path=remote_source, connection=connection)
+    # list the local destination once, rather than testing every file.
+    existing = set() if force_overwrite else {entry.name for entry in os.scandir(local_destination)}
+    todo = [file for file in files if file not in existing]
+    if verbosity>0:
+        for file in todo:
+            echo('>      copying ' + file)
+            if verbosity>1:
+                echo('>    from ' + remote_source    , err=True)
+                echo('>      to ' + local_destination, err=True)
+    return todo, len(files) - len(todo)
+#===============================================================================
+def _download(connection, local_destination, remote_source, files, max_channels):
+    """
+    Copy *files* from *remote_source* to *local_destination* concurrently over 
+    at most *max_channels* sftp channels, which are multiplexed over the single
+    ssh transport of the connection. Only channels available right away (see 
+    the *max_sessions* parameter of Connection) are opened in addition to 
+    :func:`Connection.sftp`: waiting for more could wait for ever.
+    
+    :return: the list of remote paths copied, and the list of error messages
+        of the files that failed to copy.
+    """
+    n_channels = min(max_channels, len(files))
+    channels = queue.Queue()
+    if n_channels:
+        channels.put(connection.sftp())
+    
+    def get(file):
+        sftp = channels.get()
+        try:
+            sftp.get(os.path.join(remote_source,file), os.path.join(local_destination,file))
+        finally:
+            channels.put(sftp)
+    
+    copied = []
+    failed = []
+    extra_channels = []
+    try:
+        for _ in range(n_channels-1):
+            try:
+                sftp = connection._open_sftp(timeout=0)
+            except CommandTimedOut:
+                break # continue with the channels opened so far
+            extra_channels.append(sftp)
+            channels.put(sftp)
+        n_workers = 1 + len(extra_channels)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(get,file): file for file in files}
+            for future in concurrent.futures.as_completed(futures):
+                file = futures[future]
+                if future.exception() is None:
+                    copied.append(os.path.join(remote_source,file))
+                else:
+                    failed.append(f"{file}: {future.exception()}")
+    finally:
+        for sftp in extra_channels:
+            connection._close_sftp(sftp)
+    return copied, failed
 #===============================================================================
@@ -7,14 +7,98 @@ Base class for all command classes.
 from click import echo
 #===============================================================================
 from time import sleep
+import asyncio,functools,random
 import lrcmd.exceptions
 #===============================================================================
+class CommandResult:
+    """
+    The result of executing a command.
+    
+    :ivar args: the command.
+    :ivar int returncode: the exit code of the command, or None if it did not
+        terminate (timeout).
+    :ivar str stdout: the output on stdout.
+    :ivar str stderr: the output on stderr.
+    :ivar processed: *stdout* as transformed by the post-processor, or None.
+    :ivar str repeat_messages: the messages of :func:`CommandBase.execute_repeat`.
+    :ivar int attempts: the number of attempts needed by 
+        :func:`CommandBase.execute_repeat`.
+    """
+    __slots__ = ('args','returncode','stdout','stderr','processed','repeat_messages','attempts')
+    #---------------------------------------------------------------------------
+    def __init__(self, args=None, returncode=None, stdout='', stderr=''):
+        self.args            = args
+        self.returncode      = returncode
+        self.stdout          = stdout
+        self.stderr          = stderr
+        self.processed       = None
+        self.repeat_messages = ''
+        self.attempts        = 1
+    #---------------------------------------------------------------------------
+    def __repr__(self):
+        return f"CommandResult(args={self.args!r}, returncode={self.returncode!r}, " \
+               f"stdout={self.stdout!r}, stderr={self.stderr!r})"
+    #---------------------------------------------------------------------------
+
+#===============================================================================
+def _partial_result(args, stdout, stderr):
+    """
+    The result of a command that timed out: the output captured so far, and 
+    returncode None, because the command did not terminate.
+    """
+    return CommandResult( args
+                        , stdout=(stdout or b'').decode('utf-8', errors='replace')
+                        , stderr=(stderr or b'').decode('utf-8', errors='replace')
+                        )
+#===============================================================================
+def raise_if_nonzero(result, error_log=None, what=None):
+    """
+    Raise NonZeroReturnCode if *result* has a nonzero return code. 
+    
+    This is the check done by ``run(..., check=True)``. Applying it to the 
+    result of ``run(..., check=False)`` does not execute the command again.
+    
+    :param CommandResult result: the result of a command.
+    :param error_log: a logger object to which the error message is written, 
+        or None.
+    :param str what: description of the command in the error message.
+    """
+    if result.returncode!=0:
+        what = what or f"Command '{result.args}'"
+        msg = f"\n  {what}" \
+              f"\n  yields nonzero exit code: {result.returncode}" \
+              f"\n  stderr: {result.stderr}"
+        raise lrcmd.exceptions.NonZeroReturnCode(msg, result=result, error_log=error_log)
+#===============================================================================
+def raise_if_stderr(result, error_log=None, what=None):
+    """
+    Raise Stderr if *result* has output on stderr. 
+    
+    This is the check done by ``run(..., stderr_is_error=True)``. See 
+    :func:`raise_if_nonzero`.
+    """
+    if result.stderr:
+        what = what or f"Command '{result.args}'"
+        msg = f"\n  {what}\n  yields output on stderr: \n{result.stderr}"
+        raise lrcmd.exceptions.Stderr(msg, result=result, error_log=error_log)
+#===============================================================================
 class CommandBase:
     """
     Base class for RemoteCommand and LocalCommand. 
     Derived classes typically reimplement or augmentCommandBase.__init__() 
     and execute(self,post_processor=None)
+    
+    Command classes use __slots__, to keep the memory footprint small when many
+    commands are created. Derived classes that add attributes must declare them
+    in their own __slots__.
     """
+    __slots__ = ( 'command','connection','working_directory'
+                , 'result','repeat_messages','_repeat_msgs'
+                , '_command_str','_clsname','_adaptive_delay'
+                )
+    _executor = None
+    """The executor in which :func:`execute_async` runs :func:`execute` (None
+    is the default executor of the event loop)."""
     #---------------------------------------------------------------------------
     def __init__(self,command,connection=None,working_directory=None):
         """
@@ -25,23 +109,51 @@ class CommandBase:
             raise ValueError(f"Connection argument must not be specified on a LocalCommand object.")
         self.connection = None
         self.working_directory = working_directory
+        self._command_str = ' '.join(command) if isinstance(command,list) else command
+        self._clsname = type(self).__name__
+        self._adaptive_delay = None
     #---------------------------------------------------------------------------
-    def maximum_wait_time(self,attempts=6,wait=60):
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def maximum_wait_time(attempts=6,wait=60,max_wait=None):
         """
-        Compute the maximum wait time before the command gives up.
+        Compute the maximum wait time before the command gives up (not 
+        accounting for jitter, which may increase it by a factor 1+jitter).
+        
+        This is the maximum wait time for the first repeated execution of a 
+        command. Subsequent repeated executions of the same command object start
+        from the wait time adapted to previous failures and successes (see 
+        :func:`execute_repeat`).
         """
-        return ( 2**(attempts-1) -1 )*wait
+        if max_wait is None:
+            return ( (1<<(attempts-1)) -1 )*wait
+        return sum(min(max_wait, wait*(1<<i)) for i in range(attempts-1))
     #---------------------------------------------------------------------------
-    def __repeat_message(self,msg='',verbose=False):
-        if msg:
-            msg += '\n'
-            if verbose:
-                echo(msg, err=True)
-            self.repeat_messages += msg
-        else:
-            self.repeat_messages = '' 
+    @staticmethod
+    def _backoff(delay,max_wait=None,jitter=0):
+        """
+        Actual wait time for a nominal wait time *delay*: capped at *max_wait*, 
+        and randomly perturbed by a fraction *jitter*, so that concurrent 
+        retries do not happen simultaneously.
+        """
+        if max_wait is not None:
+            delay = min(max_wait, delay)
+        if jitter:
+            delay *= 1 + random.uniform(-jitter, jitter)
+        return delay
+    #---------------------------------------------------------------------------
+    def __repeat_message(self,msg,verbose=False):
+        # The messages are joined only when execute_repeat returns or raises.
+        self._repeat_msgs.append(msg)
+        if verbose:
+            echo(msg+'\n', err=True)
     #---------------------------------------------------------------------------
-    def execute_repeat(self,attempts=6,wait=60,check=True,stderr_is_error=False,error_log=None, post_processor=None,verbose=False,timeout=None):
+    def __join_repeat_messages(self):
+        self.repeat_messages = ''.join(msg+'\n' for msg in self._repeat_msgs)
+    #---------------------------------------------------------------------------
+    def execute_repeat( self,attempts=6,wait=60,check=True,stderr_is_error=False
+                      , error_log=None, post_processor=None,verbose=False,timeout=None
+                      , max_wait=None,jitter=0.5,early_exit_on_partial=False):
         """
         Repeated execution after failure.
         
@@ -49,11 +161,24 @@ class CommandBase:
         :param int wait: seconds of wait time after the first failure, doubled on every failure.
         :param post_processor: a function the transforms the output (on stdout) of the command.
         :param bool verbose: print error message to stderr if the command fails.
+        :param float max_wait: if not None, upper bound for the wait time between
+            two attempts.
+        :param float jitter: the wait time is multiplied by a random factor 
+            in [1-jitter,1+jitter], to avoid that many commands failing at the 
+            same time (e.g. because the remote machine is overloaded) also retry
+            at the same time.
+        :param bool early_exit_on_partial: if True, and the command times out, 
+            *post_processor* is applied to the output produced before the 
+            timeout. If that does not raise and does not return None, the 
+            command is considered successful (with *returncode* None), and it is 
+            not retried.
         
-        :return: on success the output (on stdout) of the command as processed by *post_processor*, otherwise *None*
+        :return: on success the output (on stdout) of the command as processed
+            by *post_processor*, otherwise *None*
           
         If the command fails, retry it after <wait> seconds. The total number 
-        of attempts is <attempts>. After every attempt, the wait time is doubled.
+        of attempts is <attempts>. After every attempt, the wait time is doubled
+        (without jitter and max_wait):
         
         =============== === === === === ==== ====
         attempt          1   2   3   4    5   6  
@@ -67,18 +192,23 @@ class CommandBase:
         The default retries times, waiting at most 31 minutes. (This does not 
         include the time the command is being executed).
         
+        The wait time is adaptive: it is remembered by the command object, so 
+        that when the command is executed repeatedly again (e.g. when polling), 
+        it starts from the wait time that was needed before. Every successful
+        attempt decreases it by a factor 1.0109, but never below *wait*.
+        
+        Only failures that may disappear by retrying are retried. *NotConnected*
+        and *ValueError* are raised immediately.
+        
         If the repeated excution of the command fails, the accumulated error messages 
         are found in the class variable :class:`self.repeat_messages`. 
         
         This command is inherited by derived classes.
         """
-        self.repeat_messages = ''
-        
-        attempts_left = attempts
-        sleep_time = wait
+        self._repeat_msgs = []
+        self._adaptive_delay = max(wait, self._adaptive_delay or 0)
         slept_time = 0
-        self.__repeat_message()
-        while attempts_left:
+        for attempt in range(1,attempts+1):
             try:
                 self.result = self.execute( post_processor=post_processor
                                           , check=check
@@ -86,51 +216,139 @@ class CommandBase:
                                           , error_log=error_log
                                           , timeout=timeout
                                           )
-                self.__repeat_message(f"Attempt {attempts-attempts_left+1}/{attempts} succeeded after {slept_time} seconds.",verbose=verbose)
-                self.result.repeat_messages = self.repeat_messages
-                self.result.attempts = attempts-attempts_left+1
-                return self.result
+            except (lrcmd.exceptions.NotConnected, ValueError):
+                # retrying will not help
+                raise
             except Exception as e:
-                attempts_left -= 1
-                self.__repeat_message(f"Attempt {attempts-attempts_left}/{attempts} failed." \
-                                      f"\n  {type(e).__name__}: {e}"                               \
-                                      f"\n  Retrying after {sleep_time} seconds."
-                                     ,verbose=verbose
-                                     )
-                if attempts_left:
-                    sleep(wait)
+                if early_exit_on_partial and self.__accept_partial(e,post_processor):
+                    return self.__attempt_succeeded(attempt,attempts,slept_time,verbose)
+                sleep_time = self.__attempt_failed(e,attempt,attempts,wait,max_wait,jitter,verbose)
+                if attempt<attempts:
+                    sleep(sleep_time)
                     slept_time += sleep_time 
-                    sleep_time *=2
-    
-        else:
-            assert attempts_left==0
-            self.__repeat_message(f"Exhausted after {attempts} attempts.",verbose=verbose)
-            raise lrcmd.exceptions.RepeatedExecutionFailed('\n'+self.repeat_messages)
-        
-        assert False # should never happen
+            else:
+                return self.__attempt_succeeded(attempt,attempts,slept_time,verbose)
+            
+        self.__exhausted(attempts,verbose)
+    #---------------------------------------------------------------------------
+    async def execute_repeat_async( self,attempts=6,wait=60,check=True,stderr_is_error=False
+                                  , error_log=None, post_processor=None,verbose=False,timeout=None
+                                  , max_wait=None,jitter=0.5,early_exit_on_partial=False):
+        """
+        Coroutine version of :func:`execute_repeat`. The command is executed by
+        :func:`execute_async`, and the waiting between attempts does not block 
+        the event loop, so that many commands can be retried concurrently.
+        """
+        self._repeat_msgs = []
+        self._adaptive_delay = max(wait, self._adaptive_delay or 0)
+        slept_time = 0
+        for attempt in range(1,attempts+1):
+            try:
+                self.result = await self.execute_async( post_processor=post_processor
+                                                      , check=check
+                                                      , stderr_is_error=stderr_is_error
+                                                      , error_log=error_log
+                                                      , timeout=timeout
+                                                      )
+            except (lrcmd.exceptions.NotConnected, ValueError):
+                # retrying will not help
+                raise
+            except Exception as e:
+                if early_exit_on_partial and self.__accept_partial(e,post_processor):
+                    return self.__attempt_succeeded(attempt,attempts,slept_time,verbose)
+                sleep_time = self.__attempt_failed(e,attempt,attempts,wait,max_wait,jitter,verbose)
+                if attempt<attempts:
+                    await asyncio.sleep(sleep_time)
+                    slept_time += sleep_time 
+            else:
+                return self.__attempt_succeeded(attempt,attempts,slept_time,verbose)
+            
+        self.__exhausted(attempts,verbose)
+    #---------------------------------------------------------------------------
+    def __accept_partial(self,e,post_processor):
+        """
+        Test if *e* is a timeout whose partial output is accepted by 
+        *post_processor*. If so, it becomes the result of the command.
+        """
+        if post_processor is None or not isinstance(e,lrcmd.exceptions.CommandTimedOut):
+            return False
+        if not getattr(e.result,'stdout',None):
+            return False
+        try:
+            processed = post_processor(e.result.stdout)
+        except Exception:
+            return False
+        if processed is None:
+            return False
+        self.result = e.result
+        self.result.processed = processed
+        return True
+    #---------------------------------------------------------------------------
+    def __attempt_succeeded(self,attempt,attempts,slept_time,verbose):
+        self._adaptive_delay /= 1.0109
+        self.__repeat_message(f"Attempt {attempt}/{attempts} succeeded" \
+                              f" after {slept_time:.2f} seconds."
+                             ,verbose=verbose
+                             )
+        self.__join_repeat_messages()
+        self.result.repeat_messages = self.repeat_messages
+        self.result.attempts = attempt
+        return self.result
+    #---------------------------------------------------------------------------
+    def __attempt_failed(self,e,attempt,attempts,wait,max_wait,jitter,verbose):
+        """
+        Record the failure of an attempt, and return the wait time before the 
+        next attempt.
+        """
+        sleep_time = self._backoff(self._adaptive_delay, max_wait, jitter)
+        self._adaptive_delay *= 2
+        if max_wait is not None:
+            self._adaptive_delay = min(max_wait, self._adaptive_delay)
+        self.__repeat_message(f"Attempt {attempt}/{attempts} failed." \
+                              f"\n  {type(e).__name__}: {e}"          \
+                              f"\n  Retrying after {sleep_time:.2f} seconds."
+                             ,verbose=verbose
+                             )
+        return sleep_time
+    #---------------------------------------------------------------------------
+    def __exhausted(self,attempts,verbose):
+        self.__repeat_message(f"Exhausted after {attempts} attempts.",verbose=verbose)
+        self.__join_repeat_messages()
+        raise lrcmd.exceptions.RepeatedExecutionFailed('\n'+self.repeat_messages)
+    #---------------------------------------------------------------------------
+    async def execute_async( self, post_processor=None
+                           , check=True, stderr_is_error=False, timeout=None
+                           , error_log=None
+                           ):
+        """
+        Coroutine version of *execute*. By default *execute* is run in 
+        *self._executor*, so that its blocking I/O does not block the event 
+        loop. Derived classes may reimplement this with native asyncio I/O.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor( self._executor
+                                         , functools.partial( self.execute
+                                                            , post_processor=post_processor
+                                                            , check=check
+                                                            , stderr_is_error=stderr_is_error
+                                                            , timeout=timeout
+                                                            , error_log=error_log
+                                                            )
+                                         )
     #---------------------------------------------------------------------------
     def __repr__(self):
         """
         """
-        if isinstance(self.command,list):
-            cmd = ' '.join(self.command)
-        else:
-            cmd = self.command
-        r =  f"< {self.__class__}: '{cmd}'"
         if self.connection is None:
-            r += +' >'
+            return f"< {self.__class__}: '{self._command_str}' >"
         else:
-            r += f', {self.connection.label} >'
-        return r
+            return f"< {self.__class__}: '{self._command_str}', {self.connection.label} >"
     #---------------------------------------------------------------------------
     def __str__(self):
         """
         Convert the command to a str and return it.
         """
-        if isinstance(self.command,list):
-            return ' '.join(self.command)
-        else:
-            return self.command
+        return self._command_str
     #---------------------------------------------------------------------------
     def process_output(self, post_processor=None
                            , check=True,stderr_is_error=False
@@ -140,21 +358,44 @@ class CommandBase:
         Check for output on stderr and whether this is considered an error,
         and call the post_processor.
         """
-        if check:
-            if self.result.returncode!=0:
-                msg = f"\n  {type(self).__name__} '{self.command}'\n  yields nonzero exit code: {self.result.returncode}\n  stderr: {self.result.stderr}"
-                raise lrcmd.exceptions.NonZeroReturnCode(msg, result=self.result, error_log=error_log)
+        result = self.result
+        if check and result.returncode!=0:
+            raise_if_nonzero(result, error_log, f"{self._clsname} '{self._command_str}'")
         
-        if stderr_is_error:
-            if self.result.stderr:
-                msg = f"\n  {type(self).__name__} '{self.command}'\n  yields output on stderr: \n{self.result.stderr}"
-                raise lrcmd.exceptions.Stderr(msg, result=self.result, error_log=error_log)
+        if stderr_is_error and result.stderr:
+            raise_if_stderr(result, error_log, f"{self._clsname} '{self._command_str}'")
 
-        if not post_processor is None:
-            self.result.processed = post_processor(self.result.stdout)
+        if post_processor is not None:
+            # The built-in post-processors cache their results (bounded), for 
+            # commands that are executed repeatedly with the same output.
+            result.processed = post_processor(result.stdout)
             
-        return self.result
+        return result
     #---------------------------------------------------------------------------
             
 #===============================================================================
+async def execute_many(commands, *, concurrency=32, return_exceptions=False, **kwargs):
+    """
+    Execute many commands concurrently with :func:`CommandBase.execute_repeat_async`,
+    e.g. to poll many jobs, or to run the same command on many remote machines.
+    While a command is waiting to be retried, the other commands proceed.
+    
+    :param commands: an iterable of command objects.
+    :param int concurrency: the maximum number of commands that are executed 
+        simultaneously, to avoid overwhelming the remote machines or the pool
+        of ssh connections.
+    :param bool return_exceptions: if False, the first exception is raised, 
+        otherwise exceptions are returned in the list of results.
+    :param kwargs: passed to :func:`CommandBase.execute_repeat_async`.
+    :return: list with the results of the commands, in the same order.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def run_one(command):
+        async with semaphore:
+            return await command.execute_repeat_async(**kwargs)
+    return await asyncio.gather( *[run_one(command) for command in commands]
+                               , return_exceptions=return_exceptions
+                               )
+#===============================================================================
 
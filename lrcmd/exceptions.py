@@ -16,7 +16,8 @@ class FailedCommand(Exception):
         super().__init__(*args,**kwargs)
         self.result = result
         if error_log:
-            error_log.error(str(self))
+            # formatted by the logger, only if the message is emitted
+            error_log.error('%s', self)
 #===============================================================================
 class Stderr(FailedCommand):
     """
@@ -32,6 +33,15 @@ class NonZeroReturnCode(FailedCommand):
      """
     pass
 #===============================================================================
+class RemoteError(NonZeroReturnCode):
+    """
+    This exception is raised if the remote end of a transfer to the remote 
+    machine failed. Its result contains the exit status and stderr of the 
+    remote command (exit status -1 if the remote command did not report one,
+    e.g. because the connection was lost). 
+    """
+    pass
+#===============================================================================
 class RepeatedExecutionFailed(FailedCommand):
     """
     This exception is raised if execute_repeat on a command did not succeed 
@@ -7,12 +7,25 @@ Command class for executing local commands.
 import logging
 lrcmd_log = logging.getLogger('lrcmd_log')
 #===============================================================================
-import shlex,subprocess
-from types import SimpleNamespace
+import asyncio,functools,shlex,subprocess
 #===============================================================================
-from lrcmd.core       import CommandBase
+from lrcmd.core       import CommandBase, CommandResult, _partial_result
 from lrcmd.exceptions import CommandTimedOut
 #===============================================================================
+# shlex.split is slow, and the same commands are often constructed over and 
+# over again. Note that the cached list is shared, hence it must be copied.
+_split = functools.lru_cache(maxsize=512)(shlex.split)
+#===============================================================================
+async def _drain(stream, buffer):
+    """
+    Append everything read from the asyncio *stream* to *buffer*.
+    """
+    while True:
+        data = await stream.read(65536)
+        if not data:
+            return
+        buffer.extend(data)
+#===============================================================================
 class LocalCommand(CommandBase):
     """
     Class for execution local system commands, using 
@@ -23,11 +36,18 @@ class LocalCommand(CommandBase):
         *working_directory*
     :param int timeout: raise *CommandTimedOut* when the command does not 
         finish after *timeout* seconds.
+    :param session: if not None, a :class:`lrcmd.spawnpool.ShellPool` (or any
+        object with the same *run* method) in which the command is executed, 
+        rather than in a new subprocess. This avoids the cost of spawning a 
+        process for every command in loops over many short commands.
     """
-    def __init__(self,command,working_directory=None):
+    __slots__ = ('session',)
+    
+    def __init__(self,command,working_directory=None,session=None):
         super().__init__(command,working_directory=working_directory)
+        self.session = session
         if isinstance(self.command,str):
-            self.command = shlex.split(self.command)
+            self.command = list(_split(self.command))
         else:
             raise TypeError('Expecting "str" for command.')
     #---------------------------------------------------------------------------
@@ -56,19 +76,32 @@ class LocalCommand(CommandBase):
 
         :raise: *NonZeroReturnCode*, *Stderr*, *CommandTimedOut*
         """
-        self.result = SimpleNamespace()
+        if self.session is not None:
+            return self._execute_in_session( post_processor=post_processor
+                                           , check=check, stderr_is_error=stderr_is_error
+                                           , timeout=timeout, error_log=error_log
+                                           )
         try:
-            self.result = subprocess.run( self.command
-                                        , capture_output=True
-                                        , timeout=timeout
-                                        , check=False
-                                        , cwd=self.working_directory
-                                        , encoding='utf-8'
-                                        )
-        except subprocess.TimeoutExpired:
+            # No shell, no preexec_fn and close_fds=True, so that CPython can 
+            # spawn the child with posix_spawn/vfork rather than a full fork.
+            # The output is captured as bytes and decoded in one go, which is 
+            # cheaper than decoding through a text wrapper (encoding='utf-8').
+            completed = subprocess.run( self.command
+                                      , shell=False
+                                      , close_fds=True
+                                      , capture_output=True
+                                      , timeout=timeout
+                                      , check=False
+                                      , cwd=self.working_directory
+                                      )
+        except subprocess.TimeoutExpired as e:
+            self.result = _partial_result(self.command, e.stdout, e.stderr)
             msg = f"Local command '{self.command}' timed out after {timeout}s."
             raise CommandTimedOut(msg, result=self.result, error_log=error_log)
-            
+        self.result = CommandResult( self.command, completed.returncode
+                                   , completed.stdout.decode('utf-8', errors='replace')
+                                   , completed.stderr.decode('utf-8', errors='replace')
+                                   )
 
         self.process_output( post_processor=post_processor
                            , check=check, stderr_is_error=stderr_is_error
@@ -77,5 +110,76 @@ class LocalCommand(CommandBase):
         
         return self.result
     #---------------------------------------------------------------------------
+    async def execute_async( self, post_processor=None
+                           , check=True, stderr_is_error=False, timeout=None
+                           , error_log=None
+                           ):
+        """
+        Coroutine version of :func:`execute`, using an asyncio subprocess, so 
+        that many local commands can be awaited concurrently.
+        """
+        if self.session is not None:
+            return await super().execute_async( post_processor=post_processor
+                                              , check=check, stderr_is_error=stderr_is_error
+                                              , timeout=timeout, error_log=error_log
+                                              )
+        process = await asyncio.create_subprocess_exec( *self.command
+                                                      , stdout=asyncio.subprocess.PIPE
+                                                      , stderr=asyncio.subprocess.PIPE
+                                                      , cwd=self.working_directory
+                                                      )
+        # Read into buffers, rather than with process.communicate(), so that 
+        # the output read before a timeout is not lost.
+        stdout = bytearray()
+        stderr = bytearray()
+        try:
+            await asyncio.wait_for( asyncio.gather( _drain(process.stdout, stdout)
+                                                  , _drain(process.stderr, stderr)
+                                                  , process.wait()
+                                                  )
+                                  , timeout=timeout
+                                  )
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            self.result = _partial_result(self.command, stdout, stderr)
+            msg = f"Local command '{self.command}' timed out after {timeout}s."
+            raise CommandTimedOut(msg, result=self.result, error_log=error_log)
+        
+        self.result = CommandResult( self.command, process.returncode
+                                   , stdout.decode('utf-8', errors='replace')
+                                   , stderr.decode('utf-8', errors='replace')
+                                   )
+        return self.process_output( post_processor=post_processor
+                                  , check=check, stderr_is_error=stderr_is_error
+                                  , error_log=error_log
+                                  )
+    #---------------------------------------------------------------------------
+    def _execute_in_session( self, post_processor=None
+                           , check=True, stderr_is_error=False, timeout=None
+                           , error_log=None
+                           ):
+        """
+        Execute the command in *self.session*. Same as :func:`execute`.
+        """
+        command = ' '.join(shlex.quote(arg) for arg in self.command)
+        try:
+            stdout, stderr, returncode = self.session.run( command
+                                                         , working_directory=self.working_directory
+                                                         , timeout=timeout
+                                                         )
+        except subprocess.TimeoutExpired as e:
+            self.result = _partial_result(self.command, e.output, e.stderr)
+            msg = f"Local command '{self.command}' timed out after {timeout}s."
+            raise CommandTimedOut(msg, result=self.result, error_log=error_log)
+        self.result = CommandResult( self.command, returncode
+                                   , stdout.decode('utf-8', errors='replace')
+                                   , stderr.decode('utf-8', errors='replace')
+                                   )
+        return self.process_output( post_processor=post_processor
+                                  , check=check, stderr_is_error=stderr_is_error
+                                  , error_log=error_log
+                                  )
+    #---------------------------------------------------------------------------
 
 #===============================================================================    
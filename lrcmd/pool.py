@@ -0,0 +1,79 @@
+"""
+Class SSHConnectionPool
+=======================
+A pool of authenticated `paramiko <http://docs.paramiko.org>`_ clients, so that
+the (expensive) ssh handshake and authentication need not be repeated for every
+Connection object to the same remote machine, as the same user and with the 
+same authentication (ssh key or ssh-agent).
+"""
+#===============================================================================
+import atexit,threading
+from collections import deque
+#===============================================================================
+def _is_alive(client):
+    """
+    Test if the transport of a paramiko client is still active.
+    """
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+#===============================================================================
+class SSHConnectionPool:
+    """
+    Pool of idle paramiko clients, keyed by 
+    *(login_node, username, ssh_key, use_agent)* (see :func:`Connection._pool_key`).
+
+    Clients are handed out by :func:`acquire` and given back by :func:`release`.
+    Clients whose transport is no longer active are closed and transparently
+    replaced by a new client. The pool is thread safe.
+    """
+    #---------------------------------------------------------------------------
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+    #---------------------------------------------------------------------------
+    def acquire(self, key, factory):
+        """
+        Pop an idle client for *key* from the pool, or create a new one.
+
+        :param tuple key: *(login_node, username, ssh_key, use_agent)*
+        :param factory: a function without arguments returning a new, connected
+            paramiko client. It is called if there is no live idle client for
+            *key*.
+        :return: a connected paramiko client.
+        """
+        with self._lock:
+            clients = self._clients.get(key)
+            while clients:
+                client = clients.pop()
+                if _is_alive(client):
+                    return client
+                client.close()
+        return factory()
+    #---------------------------------------------------------------------------
+    def release(self, key, client):
+        """
+        Give a client back to the pool, so that it can be reused. Clients that
+        are no longer alive are closed instead.
+        """
+        if not _is_alive(client):
+            client.close()
+            return
+        with self._lock:
+            self._clients.setdefault(key, deque()).append(client)
+    #---------------------------------------------------------------------------
+    def clear(self):
+        """
+        Close all idle clients in the pool.
+        """
+        with self._lock:
+            for clients in self._clients.values():
+                while clients:
+                    clients.pop().close()
+            self._clients.clear()
+    #---------------------------------------------------------------------------
+
+#===============================================================================
+pool = SSHConnectionPool()
+"""The pool used by all Connection objects."""
+atexit.register(pool.clear)
+#===============================================================================
@@ -8,26 +8,148 @@ option of the generic *run* function or the *execute* method of *LocalCommand*,
 or *RemoteCommand*.
 """
 #===============================================================================
+import functools,io
+from collections import OrderedDict
+#===============================================================================
 try:
     import xmltodict
 except ImportError:
     xmltodict = None
+try:
+    import lxml.etree as _et
+except ImportError:
+    _et = None
 #===============================================================================
 def xml_to_odict(s):
     """
     A post-processor function that parses a string *s*, containing the xml 
-    output of a command into an OrderedDict using :func:`xmltodict.parse`.
+    output of a command into an OrderedDict. If `lxml <https://lxml.de>`_ is
+    available, its (much faster) parser is used, otherwise :func:`xmltodict.parse`.
+    Both produce the same structure.
+    
+    Every call parses *s* anew, and returns a new OrderedDict, which the 
+    caller may modify.
      
     :rtype: OrderedDict
     """
+    if _et is not None:
+        root = _et.fromstring(s.encode('utf-8'))
+        # looking up namespace declarations is expensive, avoid it if possible.
+        return OrderedDict([(_tag(root), _element_to_odict(root, 'xmlns' in s))])
     if xmltodict is None:
         msg = "Warning: lore.postprocessors:\n  Module xmltodict is not available."\
               "\n  If you need to parse xml output from a command, either install "\
-              "\n  xmltodict (using pip, conda), or activate a Python environment" \
-              "\n  which has xmltodict installed."
+              "\n  lxml or xmltodict (using pip, conda), or activate a Python "\
+              "\n  environment which has one of them installed."
         raise ImportError(msg)
     return xmltodict.parse(s)
 #===============================================================================
+def _tag(element, name=None):
+    """
+    The tag of *element* (or the name of one of its attributes), with a 
+    namespace prefix as in the xml text.
+    """
+    if name is None:
+        name = element.tag
+    if name[0] == '{':
+        uri,name = name[1:].split('}',1)
+        nsmap = getattr(element,'nsmap',{})
+        for prefix,value in nsmap.items():
+            if prefix and value == uri:
+                return f'{prefix}:{name}'
+    return name
+#===============================================================================
+def _element_to_odict(element, namespaces=True):
+    """
+    Convert an ElementTree (or lxml) element in the same way as xmltodict: 
+    attributes become '@name' keys, repeated child tags become lists, and the 
+    text becomes a '#text' key, or the value itself if the element has neither
+    attributes nor children.
+    """
+    text = element.text
+    attrib = element.attrib
+    if not attrib and not namespaces and not len(element):
+        # a leaf element, by far the most common case.
+        return text.strip() or None if text else None
+    
+    d = OrderedDict()
+    if namespaces and hasattr(element,'nsmap'): # lxml: namespace declarations are not attributes
+        _add_namespace_declarations(d, element)
+    for name,value in attrib.items():
+        d['@'+_tag(element,name)] = value
+    text = _add_children(d, element, namespaces)
+    if not d:
+        return text
+    if text is not None:
+        d['#text'] = text
+    return d
+#===============================================================================
+def _add_namespace_declarations(d, element):
+    """
+    Add the namespaces declared by lxml *element* to *d* as '@xmlns' keys.
+    """
+    parent = element.getparent()
+    inherited = parent.nsmap if parent is not None else {}
+    for prefix,uri in element.nsmap.items():
+        if inherited.get(prefix) != uri:
+            d['@xmlns:'+prefix if prefix else '@xmlns'] = uri
+#===============================================================================
+def _add_children(d, element, namespaces):
+    """
+    Add the converted children of *element* to *d*, and return the text of 
+    *element*, including the tails of its children, or None.
+    """
+    text = [element.text] if element.text else []
+    for child in element:
+        tail = child.tail
+        if tail:
+            text.append(tail)
+        tag = child.tag
+        if not isinstance(tag, str):
+            continue # comments and processing instructions
+        if tag[0] == '{':
+            tag = _tag(child)
+        value = _element_to_odict(child, namespaces)
+        if tag not in d:
+            d[tag] = value
+        elif isinstance(d[tag], list):
+            d[tag].append(value)
+        else:
+            d[tag] = [d[tag], value]
+    return ''.join(text).strip() or None
+#===============================================================================
+def xml_stream(s, tag):
+    """
+    Parse a string *s*, containing the xml output of a command, incrementally,
+    and yield an OrderedDict ``{tag: ...}`` (as :func:`xml_to_odict` would 
+    produce) for every element *tag*, e.g. for every job in the output of a 
+    job scheduler. Elements are discarded once they are converted, hence the 
+    parsed tree is never completely built in memory.
+    
+    Uses lxml if available, otherwise :mod:`xml.etree.ElementTree`.
+    """
+    source = io.BytesIO(s.encode('utf-8'))
+    namespaces = 'xmlns' in s
+    if _et is not None:
+        for _,element in _et.iterparse(source, tag=tag):
+            yield OrderedDict([(_tag(element), _element_to_odict(element, namespaces))])
+            element.clear()
+            # also drop the references of the parent to the cleared elements
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    else:
+        import xml.etree.ElementTree as ET
+        parents = []
+        for event,element in ET.iterparse(source, events=('start','end')):
+            if event == 'start':
+                parents.append(element)
+                continue
+            parents.pop()
+            if element.tag == tag:
+                yield OrderedDict([(tag, _element_to_odict(element, namespaces))])
+                if parents:
+                    parents[-1].remove(element)
+#===============================================================================
 def list_of_lines(s):
     """
     A post-processor function that splits a string *s* (the stdout output of a)
@@ -35,7 +157,12 @@ def list_of_lines(s):
     
     :rtype: a list of lines (str)
     """
-    return s.split('\n')
+    return list(_split_lines(s))
+#===============================================================================
+@functools.lru_cache(maxsize=256)
+def _split_lines(s):
+    # a tuple, so that the cached result cannot be modified by the caller.
+    return tuple(s.split('\n'))
 #===============================================================================
 def list_of_non_empty_lines(s):
     """
@@ -44,10 +171,9 @@ def list_of_non_empty_lines(s):
     
     :rtype: a list of non-empty lines (str)
     """
-    lines = list_of_lines(s)
-    nonempty_lines = []
-    for line in lines:
-        if line:
-            nonempty_lines.append(line)
-    return nonempty_lines
+    return list(_split_non_empty_lines(s))
+#===============================================================================
+@functools.lru_cache(maxsize=256)
+def _split_non_empty_lines(s):
+    return tuple([line for line in s.splitlines() if line])
 #===============================================================================
\ No newline at end of file
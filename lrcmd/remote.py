@@ -4,34 +4,288 @@ Class RemoteCommand
 Command class for executing remote commands.
 """
 #===============================================================================
-import shlex
-from types import SimpleNamespace
+import atexit,concurrent.futures,contextlib,os,select,shlex,socket,subprocess,tempfile
+from time  import monotonic
 #===============================================================================
 import paramiko
 #===============================================================================
-from lrcmd.core       import CommandBase
-from lrcmd.exceptions import CommandTimedOut
+from lrcmd.core       import CommandBase, CommandResult, _partial_result
+from lrcmd.exceptions import CommandTimedOut, NotConnected, RemoteError
+from lrcmd.spawnpool  import Shell
+#===============================================================================
+# The threads executing remote commands for execute_async. The default executor
+# of the event loop has at most 32 threads, which is too few for polling many 
+# jobs or machines concurrently. Threads are only started when needed.
+_IO_POOL_SIZE = int(os.environ.get('LRCMD_SSH_POOL_SIZE',64))
+_IO_POOL = concurrent.futures.ThreadPoolExecutor( max_workers=_IO_POOL_SIZE
+                                                , thread_name_prefix='lrcmd-ssh'
+                                                )
+atexit.register(_IO_POOL.shutdown, wait=False)
+# bytes per write to the channel in _tar_to_remote
+_CHUNK_SIZE = 2**16
+#===============================================================================
+def _read_streams(channel, stdout, stderr, timeout=None):
+    """
+    Read stdout and stderr of *channel* into the bytearrays *stdout* and 
+    *stderr*, until the remote command closes them.
+    
+    Both streams are read as data arrives. Reading them one after the other 
+    may deadlock: if the remote command fills the flow control window of 
+    stderr, it blocks before closing stdout.
+    
+    :raise: *socket.timeout* if the streams are not closed within *timeout* 
+        seconds. *stdout* and *stderr* then contain the output read so far.
+    """
+    deadline = None if timeout is None else monotonic() + timeout
+    while True:
+        if channel.recv_ready():
+            stdout.extend(channel.recv(65536))
+        elif channel.recv_stderr_ready():
+            stderr.extend(channel.recv_stderr(65536))
+        elif channel.eof_received or channel.closed:
+            return
+        else:
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                raise socket.timeout()
+            # the channel's fileno becomes readable when data or EOF arrives 
+            # on either stream.
+            select.select([channel], [], [], remaining)
+#===============================================================================
+def _transport_failed(connection, exception):
+    """
+    Test if *exception* means that the ssh transport of *connection* failed, 
+    rather than a single channel. Only the former counts as a failure for the
+    circuit breaker of the connection: e.g. a server refusing to open another 
+    channel (*paramiko.ChannelException*) is still responding.
+    
+    :rtype: bool
+    """
+    if isinstance(exception, (paramiko.ChannelException, socket.timeout)):
+        # a timed out command is not a failure of the remote machine
+        return False
+    if isinstance(exception, (EOFError, OSError)):
+        return True # socket errors
+    client = connection.paramiko_client
+    transport = None if client is None else client.get_transport()
+    return transport is None or not transport.is_active()
+#===============================================================================
+def _check_breaker(connection, command):
+    """
+    :raise: *NotConnected* if the circuit breaker of *connection* is open.
+    """
+    if not connection._breaker.allow():
+        msg = f"Remote command '{command}' not executed:" \
+              f" too many consecutive failures on {connection.label}."
+        raise NotConnected(msg)
+#===============================================================================
+@contextlib.contextmanager
+def _exec_channel(connection, command, timeout=None):
+    """
+    Execute *command* on a new channel of *connection*, and yield the channel.
+    
+    The channel holds one of the *max_sessions* slots of the connection until 
+    it is closed on exit, and the outcome is reported to the circuit breaker 
+    of the connection. Waiting for a free slot counts for the *timeout* too: 
+    the timeout of the channel is set to the time remaining.
+    
+    :raise: *NotConnected* if the circuit breaker is open, *CommandTimedOut* 
+        if no slot became available within *timeout* seconds.
+    """
+    breaker = connection._breaker
+    deadline = None if timeout is None else monotonic() + timeout
+    connection._acquire_session(timeout)
+    # only now, so that the probe of a half-open breaker always reports its 
+    # outcome.
+    try:
+        _check_breaker(connection, command)
+    except NotConnected:
+        connection._release_session()
+        raise
+    channel = None
+    try:
+        remaining = None if deadline is None else max(deadline - monotonic(), 0.001)
+        # Open a session on the existing transport directly, rather than 
+        # through SSHClient.exec_command.
+        transport = connection.paramiko_client.get_transport()
+        channel = transport.open_session(timeout=remaining)
+        channel.settimeout(remaining)
+        channel.exec_command(command)
+        yield channel
+    except (paramiko.SSHException, EOFError, OSError) as e:
+        if _transport_failed(connection, e):
+            breaker.on_failure()
+        else:
+            breaker.on_success()
+        raise
+    except Exception:
+        # raised by the caller, the transport is fine.
+        breaker.on_success()
+        raise
+    except BaseException:
+        # e.g. KeyboardInterrupt, GeneratorExit
+        breaker.on_cancel()
+        raise
+    else:
+        breaker.on_success()
+    finally:
+        if channel is not None:
+            channel.close()
+        connection._release_session()
+#===============================================================================
+def _tar_to_remote(connection, local_cmd, remote_cmd, timeout):
+    """
+    Pipe the stdout of the local tar command *local_cmd* to the stdin of the 
+    remote tar command *remote_cmd*. The remote command is executed on a new
+    channel, as a RemoteCommand is (see :func:`_exec_channel`).
+    
+    If the transfer fails, the local tar is killed. The remote end closing 
+    the channel early (e.g. because the remote tar failed, or the disk quota 
+    is exceeded) raises RemoteError with the remote exit status and stderr, 
+    rather than an uninformative error about the broken channel. 
+    
+    :return: the CommandResult of the local and of the remote command.
+    :raise: *socket.timeout* if a read or write of the transfer takes longer
+        than *timeout* seconds.
+    """
+    stdout = bytearray()
+    stderr = bytearray()
+    # stderr of the local tar goes to a file: a pipe that is not read while
+    # stdout is pumped to the channel blocks tar as soon as it is full (e.g. 
+    # of 'Permission denied' warnings).
+    tar_stderr = tempfile.TemporaryFile()
+    with tar_stderr, _exec_channel(connection, remote_cmd, timeout) as channel:
+        tar = subprocess.Popen(local_cmd, stdout=subprocess.PIPE, stderr=tar_stderr)
+        try:
+            try:
+                for chunk in iter(lambda: tar.stdout.read(_CHUNK_SIZE), b''):
+                    channel.sendall(chunk)
+                channel.shutdown_write() # end of the archive
+            except socket.timeout:
+                raise
+            except (OSError, EOFError, paramiko.SSHException) as e:
+                # the remote tar may have exited, find out why.
+                _read_streams(channel, stdout, stderr, channel.gettimeout())
+                remote_result = CommandResult( remote_cmd, channel.recv_exit_status()
+                                             , stdout.decode('utf-8', errors='replace')
+                                             , stderr.decode('utf-8', errors='replace')
+                                             )
+                msg = f"\n  Remote command '{remote_cmd}'" \
+                      f"\n  failed: {e!r}" \
+                      f"\n  exit status: {remote_result.returncode}" \
+                      f"\n  stderr: {remote_result.stderr}"
+                raise RemoteError(msg, result=remote_result) from e
+            returncode = tar.wait()
+            tar_stderr.seek(0)
+            result = CommandResult( ' '.join(local_cmd), returncode, ''
+                                  , tar_stderr.read().decode('utf-8', errors='replace')
+                                  )
+            _read_streams(channel, stdout, stderr, channel.gettimeout())
+            remote_result = CommandResult( remote_cmd, channel.recv_exit_status()
+                                         , stdout.decode('utf-8', errors='replace')
+                                         , stderr.decode('utf-8', errors='replace')
+                                         )
+        except BaseException:
+            tar.kill()
+            tar.wait()
+            raise
+        finally:
+            tar.stdout.close()
+    return result, remote_result
+#===============================================================================
+class RemoteShell(Shell):
+    """
+    A persistent shell on the remote machine of *connection*. It can be used
+    as the *session* of a RemoteCommand (and of :func:`lrcmd.run`), so that
+    many short commands do not each have to open a new ssh channel, which 
+    costs a round trip to the remote machine.
+    
+    The shell is started with ``exec_command`` rather than ``invoke_shell``: 
+    the latter allocates a pseudo terminal, which echoes the input and merges
+    stderr into stdout. 
+    
+    Unlike :class:`lrcmd.spawnpool.ShellPool`, a RemoteShell executes one 
+    command at a time. It is not thread safe.
+    
+    :param Connection connection: a valid Connection object.
+    :param str shell: the command starting the shell.
+    """
+    #---------------------------------------------------------------------------
+    def __init__(self, connection, shell='/bin/sh'):
+        self.connection = connection
+        super().__init__(shell=(shell,))
+    #---------------------------------------------------------------------------
+    def _start(self):
+        self.connection._acquire_session()
+        try:
+            transport = self.connection.paramiko_client.get_transport()
+            self.channel = transport.open_session()
+            self.channel.exec_command(' '.join(self._shell))
+        except BaseException:
+            self.connection._release_session()
+            raise
+        self._new_sentinel()
+    #---------------------------------------------------------------------------
+    def _stop(self):
+        self.channel.close()
+        self.channel = None
+        self.connection._release_session()
+    #---------------------------------------------------------------------------
+    def _write(self, data):
+        self.channel.sendall(data)
+    #---------------------------------------------------------------------------
+    def _read(self, buffers, timeout):
+        channel = self.channel
+        if channel.recv_ready():
+            buffers[0].extend(channel.recv(65536))
+        elif channel.recv_stderr_ready():
+            buffers[1].extend(channel.recv_stderr(65536))
+        elif channel.eof_received or channel.closed:
+            return False
+        else:
+            select.select([channel], [], [], timeout)
+        return True
+    #---------------------------------------------------------------------------
+    def close(self):
+        """
+        Terminate the remote shell.
+        """
+        if self.channel is None:
+            return
+        try:
+            self.channel.shutdown_write()
+        finally:
+            self._stop()
+    #---------------------------------------------------------------------------
+
 #===============================================================================
 class RemoteCommand(CommandBase):
     """
     Command that is executed remotely (on a login-node) using 
     `paramiko.client <http://docs.paramiko.org/en/2.4/api/client.html>`_ .
     """                
-    def __init__(self, connection, command,working_directory=None):
+    __slots__ = ('session',)
+    _executor = _IO_POOL
+    
+    def __init__(self, connection, command,working_directory=None,session=None):
         """
         :param str command: the command as you would type it on a terminal.
         :param Connection connection: a valid Connection object.
         :param str working_directory: if not None, *command* is executed in 
             directory *working_directory*. This is achieve by prepending *command* 
             with ``'cd <working_directory> && '``. 
+        :param RemoteShell session: if not None, the command is executed in 
+            this persistent remote shell, rather than on a new channel.
         """
         super().__init__(command, working_directory=working_directory)
+        self.session = session
         
 #         assert isinstance(connection, Connection)
         self.connection = connection
         
         if self.working_directory:
             self.command = f'cd {shlex.quote(self.working_directory)} && {self.command}'
+            self._command_str = self.command
     #---------------------------------------------------------------------------
     def execute(self, post_processor=None
                     , check=True, stderr_is_error=False, timeout=None
@@ -52,22 +306,33 @@ class RemoteCommand(CommandBase):
             complete.
         :param bool error_log: a logger object to which error messages are 
             written, or None.
-        :return: on success a types.SimpleNamespace object containing the *stdout*
+        :return: on success a :class:`lrcmd.core.CommandResult` object containing the *stdout*
             (optionally post-processed by *postprocessor*),
             *stderr*, and *returncode*, as produced by the command. 
 
         :raise: *NonZeroReturnCode*, *Stderr*, *CommandTimedOut* if the command 
-            failed.
+            failed, *NotConnected* if the connection failed too often recently.
         """
-        self.result = SimpleNamespace()
+        if self.session is not None:
+            return self._execute_in_session( post_processor=post_processor
+                                           , check=check, stderr_is_error=stderr_is_error
+                                           , timeout=timeout, error_log=error_log
+                                           )
+        
+        stdout = bytearray()
+        stderr = bytearray()
         try:
-            tpl = self.connection.paramiko_client.exec_command(self.command,timeout=timeout)
-            self.result.stdout = tpl[1].read().decode('utf-8')
-            self.result.stderr = tpl[2].read().decode('utf-8')
-            self.result.returncode = tpl[1].channel.recv_exit_status()
-        except paramiko.channel.socket.timeout:
-            msg = f"Remote command '{self.command}' timed out after {timeout}s.\n  on {self.connection.label}"
-            raise CommandTimedOut(msg, error_log=error_log)
+            with _exec_channel(self.connection, self.command, timeout) as channel:
+                _read_streams(channel, stdout, stderr, channel.gettimeout())
+                self.result = CommandResult( self.command, channel.recv_exit_status()
+                                           , stdout.decode('utf-8', errors='replace')
+                                           , stderr.decode('utf-8', errors='replace')
+                                           )
+        except socket.timeout:
+            self.result = _partial_result(self.command, stdout, stderr)
+            msg = f"Remote command '{self.command}' timed out after {timeout}s." \
+                  f"\n  on {self.connection.label}"
+            raise CommandTimedOut(msg, result=self.result, error_log=error_log)
 
         return self.process_output( check=check
                                   , stderr_is_error=stderr_is_error
@@ -75,4 +340,42 @@ class RemoteCommand(CommandBase):
                                   , post_processor=post_processor
                                   )
     #---------------------------------------------------------------------------
+    def _execute_in_session( self, post_processor=None
+                           , check=True, stderr_is_error=False, timeout=None
+                           , error_log=None
+                           ):
+        """
+        Execute the command in *self.session*. Same as :func:`execute`.
+        """
+        _check_breaker(self.connection, self.command)
+        breaker = self.connection._breaker
+        try:
+            stdout, stderr, returncode = self.session.run(self.command, timeout=timeout)
+        except subprocess.TimeoutExpired as e:
+            breaker.on_success()
+            self.result = _partial_result(self.command, e.output, e.stderr)
+            msg = f"Remote command '{self.command}' timed out after {timeout}s." \
+                  f"\n  on {self.connection.label}"
+            raise CommandTimedOut(msg, result=self.result, error_log=error_log)
+        except (paramiko.SSHException, EOFError, OSError, RuntimeError) as e:
+            if _transport_failed(self.connection, e):
+                breaker.on_failure()
+            else:
+                breaker.on_success()
+            raise
+        except BaseException:
+            # e.g. KeyboardInterrupt
+            breaker.on_cancel()
+            raise
+        breaker.on_success()
+        self.result = CommandResult( self.command, returncode
+                                   , stdout.decode('utf-8', errors='replace')
+                                   , stderr.decode('utf-8', errors='replace')
+                                   )
+        return self.process_output( check=check
+                                  , stderr_is_error=stderr_is_error
+                                  , error_log=error_log
+                                  , post_processor=post_processor
+                                  )
+    #---------------------------------------------------------------------------
     
@@ -0,0 +1,195 @@
+"""
+Class ShellPool
+===============
+A pool of persistent shell processes, for executing many short local commands
+without paying the cost of spawning a new process for every command.
+
+Commands are written to the stdin of an idle shell, followed by a sentinel line
+that reports the exit code. The output on stdout and stderr is read until the
+sentinel appears.
+"""
+#===============================================================================
+import os,re,shlex,selectors,signal,subprocess,threading,uuid
+from collections import deque
+from time        import monotonic
+#===============================================================================
+class Shell:
+    """
+    A single persistent shell process.
+
+    :param tuple shell: the command starting the shell.
+    
+    Derived classes can run the shell elsewhere (e.g. on a remote machine, see
+    :class:`lrcmd.remote.RemoteShell`) by reimplementing :func:`_start`, 
+    :func:`_stop`, :func:`_write` and :func:`_read`.
+    """
+    #---------------------------------------------------------------------------
+    def __init__(self, shell=('/bin/sh',)):
+        self._shell = list(shell)
+        self._start()
+    #---------------------------------------------------------------------------
+    def _new_sentinel(self):
+        self._sentinel = f'__END_{uuid.uuid4().hex}__'.encode()
+        self._returncode = re.compile(re.escape(self._sentinel) + rb' (\d+)\n$')
+    #---------------------------------------------------------------------------
+    def _start(self):
+        # In a process group of its own, so that _stop can kill the commands 
+        # started by the shell too.
+        self.process = subprocess.Popen( self._shell
+                                       , stdin =subprocess.PIPE
+                                       , stdout=subprocess.PIPE
+                                       , stderr=subprocess.PIPE
+                                       , close_fds=True
+                                       , start_new_session=True
+                                       )
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.process.stdout, selectors.EVENT_READ, 0)
+        self._selector.register(self.process.stderr, selectors.EVENT_READ, 1)
+        self._new_sentinel()
+    #---------------------------------------------------------------------------
+    def _stop(self):
+        self._selector.close()
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass # the shell and its commands have exited already
+        self.process.wait()
+        self.process.stdout.close()
+        self.process.stderr.close()
+    #---------------------------------------------------------------------------
+    def _restart(self):
+        self._stop()
+        self._start()
+    #---------------------------------------------------------------------------
+    def _write(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+    #---------------------------------------------------------------------------
+    def _read(self, buffers, timeout):
+        """
+        Wait at most *timeout* seconds for output, and append it to 
+        *buffers[0]* (stdout) or *buffers[1]* (stderr). 
+        
+        :return: False if the shell has exited, True otherwise.
+        """
+        for key,_ in self._selector.select(timeout):
+            data = os.read(key.fileobj.fileno(), 65536)
+            if not data:
+                return False
+            buffers[key.data].extend(data)
+        return True
+    #---------------------------------------------------------------------------
+    def run(self, command, working_directory=None, timeout=None):
+        """
+        Execute *command* in the shell. The command is executed in a subshell,
+        hence it cannot alter the state (working directory, environment
+        variables, ...) of the persistent shell.
+
+        :param str command: the command as you would type it in a terminal.
+        :param str working_directory: directory where *command* is executed.
+        :param timeout: seconds in which the command must complete.
+        :return: tuple *(stdout, stderr, returncode)*, with *stdout* and
+            *stderr* as bytes.
+        :raise: *subprocess.TimeoutExpired* if the command did not complete in
+            time. The shell is then replaced by a new one.
+        """
+        cd = f'cd {shlex.quote(working_directory)} || exit\n' if working_directory else ''
+        sentinel = self._sentinel.decode()
+        script = ( f'( {cd}{command}\n) </dev/null\n'
+                   f'echo "{sentinel} $?"\n'
+                   f'echo "{sentinel}" >&2\n'
+                 ).encode()
+        self._write(script)
+
+        out = bytearray()
+        err = bytearray()
+        buffers = (out, err)
+        stderr_end = self._sentinel + b'\n'
+        tail = len(self._sentinel) + 8 # room for ' <returncode>\n'
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            match = self._returncode.search(out, max(0, len(out) - tail))
+            if match and err.endswith(stderr_end):
+                break
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                self._restart()
+                raise subprocess.TimeoutExpired( command, timeout
+                                               , output=bytes(out), stderr=bytes(err)
+                                               )
+            if not self._read(buffers, remaining):
+                self._restart()
+                raise RuntimeError(f"Shell exited while executing '{command}'.")
+
+        stdout = bytes(out[:match.start()])
+        stderr = bytes(err[:-len(stderr_end)])
+        return stdout, stderr, int(match.group(1))
+    #---------------------------------------------------------------------------
+    def close(self):
+        """
+        Terminate the shell process.
+        """
+        self._selector.close()
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+        self.process.stderr.close()
+    #---------------------------------------------------------------------------
+    def __enter__(self):
+        return self
+    #---------------------------------------------------------------------------
+    def __exit__(self, *args):
+        self.close()
+    #---------------------------------------------------------------------------
+
+#===============================================================================
+class ShellPool:
+    """
+    A pool of *size* pre-started shell processes. The pool can be used as the
+    *session* of a LocalCommand (and of :func:`lrcmd.run`). It is thread safe:
+    if more than *size* commands are run concurrently, extra shells are started.
+
+    :param int size: number of shells started in advance.
+    :param tuple shell: the command starting a shell.
+    """
+    #---------------------------------------------------------------------------
+    def __init__(self, size=4, shell=('/bin/sh',)):
+        self.size = size
+        self._shell = shell
+        self._idle = deque(Shell(shell) for _ in range(size))
+        self._lock = threading.Lock()
+    #---------------------------------------------------------------------------
+    def run(self, command, working_directory=None, timeout=None):
+        """
+        Execute *command* in an idle shell of the pool. See :func:`Shell.run`.
+        """
+        with self._lock:
+            shell = self._idle.popleft() if self._idle else None
+        if shell is None:
+            shell = Shell(self._shell)
+        try:
+            return shell.run(command, working_directory=working_directory, timeout=timeout)
+        finally:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append(shell)
+                    shell = None
+            if shell is not None:
+                shell.close()
+    #---------------------------------------------------------------------------
+    def close(self):
+        """
+        Terminate all idle shells of the pool.
+        """
+        with self._lock:
+            while self._idle:
+                self._idle.popleft().close()
+    #---------------------------------------------------------------------------
+    def __enter__(self):
+        return self
+    #---------------------------------------------------------------------------
+    def __exit__(self, *args):
+        self.close()
+    #---------------------------------------------------------------------------
+
+#===============================================================================
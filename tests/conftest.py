@@ -0,0 +1,45 @@
+"""
+pytest fixtures shared by the test modules
+"""
+#===============================================================================
+import os, sys, logging
+import pytest
+#===============================================================================
+# The log records of the tests need no thread and process information. Not
+# collecting it saves a few lookups per record.
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+#===============================================================================
+def pytest_configure(config):
+    config.addinivalue_line('markers', "fast: test that needs no subprocesses and no remote"
+                                       " machine, and completes in milliseconds"
+                                       " (select with '-m fast')")
+    config.addinivalue_line('markers', "remote: test that needs a connection to the remote machine"
+                                       " (deselect with '-m \"not remote\"')")
+#===============================================================================
+@pytest.fixture(scope='session')
+def lrcmd_log():
+    """
+    A logger which writes to stderr and to file lrcmd.log.txt. It is set up 
+    once per test session, and only if a test uses it. Under pytest-xdist every
+    worker writes to its own file lrcmd.log.<worker>.txt.
+    """
+    from lrcmd import __version__
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    filename = f"lrcmd.log.{worker}.txt" if worker else "lrcmd.log.txt"
+    prefix = f"{{levelname}}: {{name}} (lrcmd v{__version__})"
+    
+    log = logging.getLogger('lrcmd_log')
+    logfile_handler = logging.FileHandler(filename,mode='w')
+    logfile_handler.setFormatter(logging.Formatter(prefix+" : {asctime} {message}\n", style='{'))
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setLevel(logging.INFO)
+    stderr_handler.setFormatter(logging.Formatter(prefix+" {message}\n", style='{'))
+    log.addHandler(logfile_handler)
+    log.addHandler(stderr_handler)
+    yield log
+    log.removeHandler(stderr_handler)
+    log.removeHandler(logfile_handler)
+    logfile_handler.close()
+#===============================================================================
@@ -2,7 +2,8 @@
 test local commands
 """
 #===============================================================================
-import os, sys
+import os, sys, time, asyncio, socket, subprocess
+from types import SimpleNamespace
 from click import echo
 #===============================================================================
 # Make sure that the current directory is the project directory.
@@ -19,6 +20,12 @@ assert os.path.exists('./tests')
 project_dir = os.path.basename(cwd)
 test_dir = os.path.join(cwd,'tests')
 test_data_dir = os.path.join(test_dir,'data')
+# Under pytest-xdist ('make test-parallel') the tests of a module may run 
+# simultaneously in different worker processes. Each worker gets its own 
+# scratch directory, so that tests creating and removing files do not 
+# interfere.
+worker = os.environ.get('PYTEST_XDIST_WORKER')
+scratch_dir = os.path.join(test_data_dir,worker) if worker else test_data_dir
 # Make sure that we can import the module being tested. When running
 # 'make test" and 'pytest' in the project directory, the current working
 # directory is not automatically added to sys.path.
@@ -26,27 +33,29 @@ if not ('.' in sys.path or os.getcwd() in sys.path):
     echo(f"Adding '.' to sys.path.\n")
     sys.path.insert(0, '.')
 #===============================================================================
-from lrcmd                import run,__version__
-from lrcmd.postprocessors import list_of_lines,list_of_non_empty_lines
+from lrcmd                import run, run_async, raise_if_nonzero, raise_if_stderr
+from lrcmd.postprocessors import list_of_lines,list_of_non_empty_lines,xml_to_odict,xml_stream
 from lrcmd.commands       import ensure_dir,exists,remove,touch, glob,rename,env
 from lrcmd.exceptions     import NonZeroReturnCode, Stderr,RepeatedExecutionFailed,\
                                   CommandTimedOut
-#===============================================================================    
-# setup a logger which writes to stderr and to file lrcmd.log.txt
-import logging
-lrcmd_log = logging.getLogger('lrcmd_log')
-logfile_handler = logging.FileHandler("lrcmd.log.txt",mode='w')
-logfile_formatter = logging.Formatter(f"%(levelname)s: %(name)s (lrcmd v{__version__}) : %(asctime)s %(message)s\n")
-logfile_handler.setFormatter(logfile_formatter)
-stderr_handler = logging.StreamHandler(sys.stderr)
-stderr_handler.setLevel(logging.INFO)
-stderr_formatter = logging.Formatter(f"%(levelname)s: %(name)s (lrcmd v{__version__}) %(message)s\n")
-stderr_handler.setFormatter(stderr_formatter)
-lrcmd_log.addHandler(logfile_handler)
-lrcmd_log.addHandler(stderr_handler)
+from lrcmd.spawnpool      import ShellPool
+from lrcmd.core           import CommandBase, CommandResult, execute_many
+from lrcmd.local          import LocalCommand
+from lrcmd.breaker        import CircuitBreaker
+from lrcmd.remote         import _transport_failed, _exec_channel
 #===============================================================================
+import paramiko
 import pytest
 #===============================================================================
+@pytest.fixture(scope='module', autouse=True)
+def scratch():
+    """
+    Remove the scratch directory of a pytest-xdist worker after the last test.
+    """
+    yield
+    if worker and exists(scratch_dir):
+        remove(scratch_dir)
+#===============================================================================
 # tests
 #===============================================================================
 def test_echo():
@@ -85,11 +94,37 @@ def test_list_of_non_empty_lines():
     expected = [line for line in expected if line]
     assert result.processed==expected
 #===============================================================================
+jobs_xml = '<jobs xmlns:p="urn:p"><job id="1"><name>a</name><p:state>R</p:state></job>' \
+           '<job id="2"><name>b</name>text</job><!-- comment --></jobs>'
+#===============================================================================
+def test_xml_to_odict():
+    xmltodict = pytest.importorskip('xmltodict')
+    pytest.importorskip('lxml')
+    assert xml_to_odict(jobs_xml) == xmltodict.parse(jobs_xml)
+    # the result is not shared with later calls
+    xml_to_odict(jobs_xml)['jobs']['@host'] = 'modified'
+    assert xml_to_odict(jobs_xml) == xmltodict.parse(jobs_xml)
+#===============================================================================
+def test_xml_stream():
+    jobs = list(xml_stream(jobs_xml,'job'))
+    assert [job['job']['@id'] for job in jobs] == ['1','2']
+    assert jobs[1]['job']['#text'] == 'text'
+#===============================================================================
 def test_exists_existing():
     assert exists(test_data_dir)
 #===============================================================================
 def test_exists_inexisting():
-    assert not exists(os.path.join(test_data_dir,'inexisting'))
+    assert not exists(os.path.join(scratch_dir,'inexisting'))
+#===============================================================================
+def test_exists_operators():
+    script = os.path.join(test_data_dir,'test_succeeds_the_second_time.sh')
+    assert     exists(test_data_dir,operator='-d')
+    assert not exists(test_data_dir,operator='-f')
+    assert     exists(script,operator='-f')
+    assert     exists(script,operator='-x')
+    assert     exists(script,operator='-s')
+    # an operator that is not evaluated in Python
+    assert     exists(script,operator='-O')
 #===============================================================================
 def test_ensure_dir_existing():
     assert exists(test_data_dir)
@@ -98,7 +133,7 @@ def test_ensure_dir_existing():
 #===============================================================================
 def test_ensure_dir_inexisting():
     # make sure that inexisting does not yet exists
-    inexisting = os.path.join(test_data_dir,'inexisting')
+    inexisting = os.path.join(scratch_dir,'inexisting')
     if exists(inexisting):
         remove(inexisting)
     assert not exists(inexisting)
@@ -113,21 +148,20 @@ def test_ensure_dir_inexisting():
 def test_ls_inexisting():
     # ls on a inexisting directory produces a nonzero return code (1), and a
     # diagnostic message on stderr
-    cmd = f"ls {os.path.join(test_data_dir,'inexisting')}"
+    cmd = f"ls {os.path.join(scratch_dir,'inexisting')}"
+    # execute once, and check the result in two ways
+    result = run(cmd,check=False)
+    assert result.returncode == 1
+    assert bool(result.stderr)
+    with pytest.raises(NonZeroReturnCode) as e:
+        raise_if_nonzero(result)
+    assert e.value.result is result
+    with pytest.raises(Stderr) as e:
+        raise_if_stderr(result)
+    assert e.value.result is result
+    # run raises the same exceptions
     with pytest.raises(NonZeroReturnCode):
-        try:
-            run(cmd)
-        except NonZeroReturnCode as e: 
-            assert e.result.returncode == 1
-            assert bool(e.result.stderr)
-            raise
-    with pytest.raises(Stderr):
-        try:
-            run(cmd,stderr_is_error=True,check=False)
-        except Stderr as e:
-            assert e.result.returncode == 1
-            assert bool(e.result.stderr)
-            raise
+        run(cmd)
 #===============================================================================
 def test_no_timeout():
     # this must not timeout
@@ -139,10 +173,12 @@ def test_no_timeout():
     assert not bool(result.stdout)
     assert not bool(result.stderr)
 #===============================================================================
-def test_timeout():
+def test_timeout(lrcmd_log):
     # this must timeout
     timeout = 1
-    sleep = timeout
+    # sleeping exactly *timeout* seconds is not guaranteed to time out on a 
+    # busy machine (e.g. with 'make test-parallel') 
+    sleep = 2*timeout
     cmd = f"sleep {sleep}"
     with pytest.raises(CommandTimedOut):
         run(cmd,timeout=timeout,error_log=lrcmd_log)
@@ -169,6 +205,259 @@ def test_repeated_execution_succeeds():
     # clean up
     remove(newdir)
 #===============================================================================
+def test_execute_async():
+    async def sleep_concurrently():
+        cmds = [LocalCommand("sleep .5") for _ in range(8)]
+        return await asyncio.gather(*[cmd.execute_async() for cmd in cmds])
+    start = time.monotonic()
+    results = asyncio.run(sleep_concurrently())
+    # the commands overlapped: executed one after the other they take 4s. 
+    # (Not a tighter bound, which fails on loaded CI machines.)
+    assert time.monotonic()-start < 4/2
+    assert all(result.returncode==0 for result in results)
+    
+    with pytest.raises(CommandTimedOut):
+        asyncio.run(LocalCommand("sleep 1").execute_async(timeout=.2))
+    with pytest.raises(RepeatedExecutionFailed):
+        asyncio.run(LocalCommand("sleep 1").execute_repeat_async(attempts=2,wait=.1,timeout=.2))
+#===============================================================================
+def test_run_async():
+    async def main():
+        # the waits between the attempts of the first command do not block 
+        # the other commands
+        return await asyncio.gather( run_async( "sleep 1"
+                                              , attempts=3,wait=.2,jitter=0,timeout=.1,verbose=False
+                                              )
+                                   , *[run_async("sh -c 'sleep 1; echo ok'") for _ in range(3)]
+                                   , return_exceptions=True
+                                   )
+    start = time.monotonic()
+    results = asyncio.run(main())
+    # the commands overlapped: executed one after the other they take 3s, plus
+    # .3s of timeouts and .6s of waits for the first one.
+    assert time.monotonic()-start < 3.9/2
+    assert isinstance(results[0],RepeatedExecutionFailed)
+    assert [result.stdout for result in results[1:]] == ['ok\n']*3
+#===============================================================================
+def test_execute_many():
+    commands = [LocalCommand(f"sh -c 'sleep .5; echo {i}'") for i in range(6)]
+    start = time.monotonic()
+    results = asyncio.run(execute_many(commands,concurrency=3,attempts=1))
+    # two rounds of three concurrent commands: at least 1s, and well below the
+    # 3s needed to execute them one after the other.
+    assert 1 <= time.monotonic()-start < 3/1.5
+    assert [result.stdout for result in results] == [f'{i}\n' for i in range(6)]
+    
+    commands = [LocalCommand("true"),LocalCommand("false")]
+    results = asyncio.run(execute_many(commands,return_exceptions=True,attempts=1))
+    assert results[0].returncode==0
+    assert isinstance(results[1],RepeatedExecutionFailed)
+#===============================================================================
+def test_partial_output_on_timeout():
+    cmd = "sh -c 'echo first; sleep 2; echo second'"
+    with pytest.raises(CommandTimedOut) as e:
+        LocalCommand(cmd).execute(timeout=.5)
+    assert e.value.result.stdout == 'first\n'
+    assert e.value.result.returncode is None
+    with pytest.raises(CommandTimedOut) as e:
+        asyncio.run(LocalCommand(cmd).execute_async(timeout=.5))
+    assert e.value.result.stdout == 'first\n'
+    
+    def first_line(s):
+        return s.split('\n')[0] if s.startswith('first') else None
+    result = LocalCommand(cmd).execute_repeat( attempts=3,wait=1,timeout=.5
+                                             , post_processor=first_line
+                                             , early_exit_on_partial=True
+                                             )
+    assert result.processed == 'first'
+    assert result.attempts == 1
+#===============================================================================
+def test_maximum_wait_time():
+    assert CommandBase.maximum_wait_time() == 31*60
+    assert LocalCommand("true").maximum_wait_time(attempts=4,wait=1) == 7
+    assert CommandBase.maximum_wait_time(attempts=6,wait=1,max_wait=4) == 1+2+4+4+4
+#===============================================================================
+def test_backoff():
+    assert CommandBase._backoff(8) == 8
+    assert CommandBase._backoff(8,max_wait=5) == 5
+    for _ in range(100):
+        assert 2 <= CommandBase._backoff(4,jitter=.5) <= 6
+#===============================================================================
+def test_adaptive_wait():
+    cmd = LocalCommand("false")
+    with pytest.raises(RepeatedExecutionFailed):
+        cmd.execute_repeat(attempts=3,wait=.01,jitter=0)
+    assert cmd.repeat_messages.count('failed.') == 3
+    assert cmd.repeat_messages.endswith('Exhausted after 3 attempts.\n')
+    # the wait time doubled after every failure
+    assert cmd._adaptive_delay == pytest.approx(.08)
+    # and decreases on success
+    cmd = LocalCommand("true")
+    cmd._adaptive_delay = .08
+    cmd.execute_repeat(attempts=3,wait=.01)
+    assert cmd._adaptive_delay == pytest.approx(.08/1.0109)
+#===============================================================================
+class ScriptedCommand(CommandBase):
+    """
+    A fake command for testing the timeout and retry logic of CommandBase in 
+    milliseconds, without executing anything. Every execution takes the next 
+    *(duration, returncode)* pair from *script*: it sleeps *duration* seconds 
+    and yields *returncode*, or it times out if *duration* exceeds the timeout.
+    """
+    __slots__ = ('script',)
+    def __init__(self, script):
+        super().__init__('scripted')
+        self.script = list(script)
+    def execute(self, post_processor=None, check=True, stderr_is_error=False
+                    , timeout=None, error_log=None):
+        duration, returncode = self.script.pop(0)
+        if timeout is not None and duration > timeout:
+            time.sleep(timeout)
+            self.result = CommandResult(self.command)
+            raise CommandTimedOut( f"'{self.command}' timed out after {timeout}s."
+                                 , result=self.result, error_log=error_log
+                                 )
+        time.sleep(duration)
+        self.result = CommandResult(self.command, returncode)
+        return self.process_output( post_processor=post_processor
+                                  , check=check, stderr_is_error=stderr_is_error
+                                  , error_log=error_log
+                                  )
+#===============================================================================
+@pytest.mark.fast
+def test_fake_no_timeout():
+    result = ScriptedCommand([(.001,0)]).execute(timeout=.01)
+    assert result.returncode == 0
+#===============================================================================
+@pytest.mark.fast
+def test_fake_timeout():
+    with pytest.raises(CommandTimedOut) as e:
+        ScriptedCommand([(.01,0)]).execute(timeout=.001)
+    assert e.value.result.returncode is None
+#===============================================================================
+@pytest.mark.fast
+def test_fake_repeated_execution_fails():
+    cmd = ScriptedCommand([(.01,0)]*3)
+    with pytest.raises(RepeatedExecutionFailed):
+        cmd.execute_repeat(attempts=3,wait=.001,timeout=.001)
+    assert cmd.repeat_messages.count('CommandTimedOut') == 3
+    assert not cmd.script
+#===============================================================================
+@pytest.mark.fast
+def test_fake_repeated_execution_succeeds():
+    cmd = ScriptedCommand([(0,1),(.01,0),(0,0)])
+    result = cmd.execute_repeat(attempts=3,wait=.001,timeout=.005)
+    assert result.attempts == 3
+    assert cmd.repeat_messages.count('NonZeroReturnCode') == 1
+    assert cmd.repeat_messages.count('CommandTimedOut') == 1
+#===============================================================================
+def test_post_processor_cache():
+    calls = []
+    
+    def count_lines(s):
+        calls.append(s)
+        return list_of_lines(s)
+    cmd = LocalCommand("echo hello")
+    r1 = cmd.execute(post_processor=count_lines).processed
+    r2 = cmd.execute(post_processor=count_lines).processed
+    # user post-processors are not cached, they need not be pure or hashable
+    assert len(calls)==2
+    # every execution gets its own processed output
+    r1.append('modified')
+    assert r2 == ['hello','']
+    # the cache of the built-in post-processors is bounded, and cannot be 
+    # modified through the returned list
+    list_of_lines('a\nb').append('c')
+    assert list_of_lines('a\nb') == ['a','b']
+    from lrcmd.postprocessors import _split_lines
+    for i in range(300):
+        list_of_lines(f'{i}\n')
+    assert _split_lines.cache_info().currsize <= _split_lines.cache_info().maxsize
+#===============================================================================
+def test_str_repr():
+    cmd = LocalCommand("printf 'a b'")
+    assert str(cmd) == "printf 'a b'"
+    assert repr(cmd).endswith("'printf 'a b'' >")
+    assert not hasattr(cmd,'__dict__')
+#===============================================================================
+def test_command_result():
+    result = run("echo hello",post_processor=list_of_non_empty_lines)
+    assert isinstance(result,CommandResult)
+    assert not hasattr(result,'__dict__')
+    assert result.processed == ['hello']
+    assert result.attempts == 1
+#===============================================================================
+def test_circuit_breaker():
+    breaker = CircuitBreaker(fail_threshold=2,reset_timeout=.2)
+    assert breaker.allow()
+    breaker.on_failure()
+    assert breaker.allow()
+    breaker.on_failure()
+    assert breaker.state=='open'
+    assert not breaker.allow()
+    
+    time.sleep(.2)
+    assert breaker.state=='half-open'
+    assert     breaker.allow() # the probe
+    assert not breaker.allow() # others must wait for the result of the probe
+    breaker.on_failure()
+    assert breaker.state=='open'
+    
+    time.sleep(.2)
+    assert     breaker.allow()
+    assert not breaker.allow()
+    breaker.on_cancel() # e.g. KeyboardInterrupt during the probe
+    assert breaker.state=='half-open'
+    assert breaker.allow()
+    breaker.on_success()
+    assert breaker.state=='closed'
+    assert breaker.allow()
+#===============================================================================
+def test_local_commands_without_paramiko():
+    # local users of lrcmd.commands do not need paramiko (this module imports
+    # it, hence a fresh interpreter).
+    code = "import sys, lrcmd.commands; assert 'paramiko' not in sys.modules"
+    subprocess.run([sys.executable,'-c',code],check=True)
+#===============================================================================
+@pytest.mark.fast
+def test_transport_failed():
+    class Transport:
+        active = True
+        
+        def is_active(self):
+            return self.active
+    transport = Transport()
+    connection = SimpleNamespace(paramiko_client=SimpleNamespace(get_transport=lambda: transport))
+    # the server refused a channel, but is responding
+    refused = paramiko.ChannelException(1,'Administratively prohibited')
+    assert not _transport_failed(connection, refused)
+    assert not _transport_failed(connection, paramiko.SSHException('Channel closed.'))
+    assert not _transport_failed(connection, socket.timeout())
+    assert     _transport_failed(connection, EOFError())
+    assert     _transport_failed(connection, OSError('Socket is closed'))
+    transport.active = False
+    assert     _transport_failed(connection, paramiko.SSHException('SSH session not active'))
+#===============================================================================
+@pytest.mark.fast
+def test_interrupted_probe():
+    channel = SimpleNamespace( settimeout=lambda timeout: None
+                             , exec_command=lambda command: None
+                             , close=lambda: None
+                             )
+    transport = SimpleNamespace(open_session=lambda timeout: channel)
+    connection = SimpleNamespace( label='fake'
+                                , _breaker=CircuitBreaker(fail_threshold=1,reset_timeout=0)
+                                , _acquire_session=lambda timeout: None
+                                , _release_session=lambda: None
+                                , paramiko_client=SimpleNamespace(get_transport=lambda: transport)
+                                )
+    connection._breaker.on_failure()
+    with pytest.raises(KeyboardInterrupt):
+        with _exec_channel(connection,'true'): # the probe
+            raise KeyboardInterrupt
+    # the next call may probe
+    assert connection._breaker.state=='half-open'
+#===============================================================================
 def test_touch():
     path = os.path.join(test_data_dir,'touch')
     if exists(path):
@@ -232,6 +521,45 @@ def test_env():
 #     assert env('$varthatdoesnotexist',leibniz)==''
     assert env('UsR') == ''
 #===============================================================================
+def test_shell_pool():
+    with ShellPool(size=2) as pool:
+        result = run("echo hello world",session=pool)
+        assert result.returncode==0
+        assert result.stderr==''
+        assert result.stdout=='hello world\n'
+        
+        result = run("pwd",working_directory=test_data_dir,session=pool)
+        assert result.stdout==test_data_dir+'\n'
+        
+        cmd = f"ls {os.path.join(scratch_dir,'inexisting')}"
+        with pytest.raises(NonZeroReturnCode):
+            run(cmd,session=pool)
+            
+        with pytest.raises(CommandTimedOut):
+            run("sleep 1",timeout=.2,session=pool)
+        # the pool is still usable after a timeout
+        assert run("echo again",session=pool).stdout=='again\n'
+#===============================================================================
+def test_shell_pool_timeout_kills_command():
+    with ShellPool(size=1) as pool:
+        with pytest.raises(subprocess.TimeoutExpired) as exc_info:
+            pool.run("sh -c 'echo $$; exec sleep 37'",timeout=.3)
+    pid = int(exc_info.value.output)
+    # the command is killed, as by subprocess.run, rather than orphaned
+    
+    def running():
+        try:
+            os.kill(pid,0)
+        except ProcessLookupError:
+            return False
+        # killed, but not yet reaped (linux)
+        ps = subprocess.run(['ps','-o','stat=','-p',str(pid)],capture_output=True,text=True)
+        return not ps.stdout.startswith('Z')
+    deadline = time.monotonic() + 2
+    while running():
+        assert time.monotonic() < deadline, f"'sleep 37' (pid {pid}) is still running."
+        time.sleep(.05)
+#===============================================================================
     
 #===============================================================================
 # The code below is for debugging a particular test in eclipse/pydev.
@@ -241,7 +569,9 @@ if __name__=="__main__":
     the_test_you_want_to_debug = test_exists_existing
 
     from execution_trace import trace
-    with trace(f"__main__ running {the_test_you_want_to_debug}",'-*# finished #*-',singleline=False,combine=False):
+    with trace( f"__main__ running {the_test_you_want_to_debug}",'-*# finished #*-'
+              , singleline=False,combine=False
+              ):
         the_test_you_want_to_debug()
 #===============================================================================
 
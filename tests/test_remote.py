@@ -2,7 +2,7 @@
 test local commands
 """
 #===============================================================================
-import os, sys
+import os, sys, time, asyncio, subprocess, shutil, fnmatch
 from click import echo
 #===============================================================================
 # Make sure that the current directory is the project directory.
@@ -19,6 +19,12 @@ assert os.path.exists('./tests')
 project_dir = os.path.basename(cwd)
 test_dir = os.path.join(cwd,'tests')
 test_data_dir = os.path.join(test_dir,'data')
+# Under pytest-xdist ('make test-parallel') the tests of a module may run 
+# simultaneously in different worker processes. Each worker gets its own 
+# remote scratch directory, so that tests creating and removing files do not 
+# interfere.
+worker = os.environ.get('PYTEST_XDIST_WORKER')
+scratch_dir = os.path.join('data',worker) if worker else 'data'
 # Make sure that we can import the module being tested. When running
 # 'make test" and 'pytest' in the project directory, the current working
 # directory is not automatically added to sys.path.
@@ -26,36 +32,112 @@ if not ('.' in sys.path or os.getcwd() in sys.path):
     echo(f"Adding '.' to sys.path.\n")
     sys.path.insert(0, '.')
 #===============================================================================
-from lrcmd                import run, Connection,__version__
+from lrcmd                import run, run_async, Connection, raise_if_nonzero, raise_if_stderr
 from lrcmd.postprocessors import list_of_lines,list_of_non_empty_lines
 from lrcmd.commands       import ensure_dir,exists,remove,touch, glob,rename,env
+from lrcmd.commands       import exists_cache
 from lrcmd.exceptions     import NonZeroReturnCode, Stderr, CommandTimedOut, RepeatedExecutionFailed
-from lrcmd.commands       import copy_local_to_remote
+from lrcmd.exceptions     import NotConnected, RemoteError
+from lrcmd.commands       import copy_local_to_remote, rsync_local_to_remote
+from lrcmd.commands       import copy_glob_remote_to_local
+import lrcmd.commands
+from lrcmd.remote         import RemoteShell, RemoteCommand, _tar_to_remote
+from lrcmd.core           import execute_many
 #===============================================================================
 from types import SimpleNamespace
 me = SimpleNamespace( username = 'vsc20170'
                     , sshkey   = '/Users/etijskens/.ssh/et_rsa'
                     )
 #===============================================================================
-leibniz1 = Connection( login_node='login1-leibniz.uantwerpen.be'
-                                   , username  =me.username
-                                   , ssh_key   =me.sshkey
-                                   )
-#===============================================================================
 import pytest
-#===============================================================================    
-# setup a logger which writes to stderr and to file lrcmd.log.txt
-import logging
-lrcmd_log = logging.getLogger('lrcmd_log')
-logfile_handler = logging.FileHandler("lrcmd.log.txt",mode='w')
-logfile_formatter = logging.Formatter(f"%(levelname)s: %(name)s (lrcmd v{__version__}) : %(asctime)s %(message)s\n")
-logfile_handler.setFormatter(logfile_formatter)
-stderr_handler = logging.StreamHandler(sys.stderr)
-stderr_handler.setLevel(logging.INFO)
-stderr_formatter = logging.Formatter(f"%(levelname)s: %(name)s (lrcmd v{__version__}) %(message)s\n")
-stderr_handler.setFormatter(stderr_formatter)
-lrcmd_log.addHandler(logfile_handler)
-lrcmd_log.addHandler(stderr_handler)
+# all tests in this module need the remote machine
+pytestmark = pytest.mark.remote
+#===============================================================================
+try:
+    leibniz1 = Connection( login_node='login1-leibniz.uantwerpen.be'
+                                       , username  =me.username
+                                       , ssh_key   =me.sshkey
+                                       )
+except NotConnected as e:
+    # e.g. CI without access to the remote machine
+    pytest.skip(str(e), allow_module_level=True)
+#===============================================================================
+@pytest.fixture(scope='module', autouse=True)
+def ssh_master():
+    """
+    Close the OpenSSH master connection opened by tests using 
+    leibniz1.ssh_args(), and the paramiko connection, after the last test.
+    """
+    yield
+    subprocess.run(['ssh',*leibniz1.ssh_args(),'-O','exit',leibniz1.login_node]
+                  , capture_output=True
+                  )
+    leibniz1.close()
+#===============================================================================
+@pytest.fixture(scope='module', autouse=True)
+def remote_data():
+    """
+    Ensure the remote directories 'data' and *scratch_dir* once for all tests,
+    and remove whatever the tests leave behind (e.g. after a failure) after 
+    the last test.
+    """
+    ensure_dir(scratch_dir,connection=leibniz1)
+    yield
+    if worker:
+        leftovers = [scratch_dir]
+    else:
+        leftovers = [os.path.join(scratch_dir,p) for p in ( 'inexisting','newdir','cached'
+                                                          , 'copied.sh'
+                                                          , 'test_succeeds_the_second_time.sh'
+                                                          , 'touch','glob','rename','copy_glob'
+                                                          , 'copied_dir','not_a_dir'
+                                                          )]
+    run(f"rm -rf {' '.join(leftovers)}",connection=leibniz1)
+#===============================================================================
+@pytest.fixture(scope='session')
+def ssh_agent():
+    """
+    Start an ssh-agent holding *me.sshkey* (you are prompted for its 
+    passphrase, if any, only once per test session), and kill it after the
+    session. 
+    """
+    if shutil.which('ssh-agent') is None:
+        pytest.skip('ssh-agent is not available')
+    output = subprocess.run(['ssh-agent','-s'],capture_output=True,text=True,check=True).stdout
+    # output is like 'SSH_AUTH_SOCK=/tmp/ssh-XXX/agent.123; export SSH_AUTH_SOCK;\n...'
+    agent_env = dict( line.split(';')[0].split('=',1) 
+                      for line in output.splitlines() if line.startswith('SSH_')
+                    )
+    saved_env = {var: os.environ.get(var) for var in agent_env}
+    os.environ.update(agent_env)
+    try:
+        subprocess.run(['ssh-add',me.sshkey],check=True)
+        yield agent_env['SSH_AUTH_SOCK']
+    finally:
+        subprocess.run(['ssh-agent','-k'],capture_output=True)
+        for var,value in saved_env.items():
+            if value is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = value
+#===============================================================================
+@pytest.fixture
+def cached_exists():
+    """
+    Cache the results of exists() during a test that modifies the remote 
+    file system only through lrcmd.commands. 
+    """
+    with exists_cache():
+        yield
+#===============================================================================
+def run_batch(statements,connection=leibniz1,**kwargs):
+    """
+    Execute a list of shell *statements* as a single remote command, i.e. in a
+    single round trip, rather than one round trip per statement. Execution 
+    stops at the first failing statement.
+    """
+    script = '\n'.join(['set -e',*statements])
+    return run(script,connection=connection,**kwargs)
 #===============================================================================
 # tests
 #===============================================================================
@@ -105,49 +187,148 @@ def test_exists_existing():
 def test_exists_inexisting():
     assert not exists('inexisting',connection=leibniz1)
 #===============================================================================
-def test_ensure_dir_existing():
+def test_ensure_dir_existing(cached_exists):
     assert exists('data',connection=leibniz1)
     ensure_dir   ('data',connection=leibniz1)
     assert exists('data',connection=leibniz1)
 #===============================================================================
-def test_ensure_dir_inexisting():
+def test_ensure_dir_inexisting(cached_exists):
     # make sure that inexisting does not yet exists
-    inexisting = os.path.join('data','inexisting')
-    if exists(inexisting,connection=leibniz1):
-        remove(inexisting,connection=leibniz1)
-    assert not exists(inexisting,connection=leibniz1)
+    inexisting = os.path.join(scratch_dir,'inexisting')
+    run_batch([f"rm -rf {inexisting}"
+              ,f"[ ! -e {inexisting} ]"
+              ])
     
     # make inexisting and check
     ensure_dir(inexisting,connection=leibniz1)
     
     assert exists(inexisting,connection=leibniz1)
     
-    # clean up
-    remove(inexisting,connection=leibniz1)
-    assert not exists(inexisting,connection=leibniz1)
+    # clean up, and check, in a single round trip
+    result = run_batch([f"rm -rf {inexisting}"
+                       ,f"[ -e {inexisting} ] && echo exists || echo removed"
+                       ])
+    assert result.stdout == 'removed\n'
+#===============================================================================
+def test_exists_cache():
+    parent = os.path.join(scratch_dir,'cached')
+    p = os.path.join(parent,'dir')
+    run_batch([f"rm -rf {parent}"])
+    with exists_cache():
+        assert not exists(p,connection=leibniz1)
+        ensure_dir(p,connection=leibniz1)
+        assert exists(p,connection=leibniz1)
+        # removing the parent also forgets p
+        remove(parent,connection=leibniz1)
+        assert not exists(p,connection=leibniz1)
+        # changes not made through lrcmd.commands go unnoticed
+        run_batch([f"mkdir -p {p}"])
+        assert not exists(p,connection=leibniz1)
+    assert exists(p,connection=leibniz1)
+    remove(parent,connection=leibniz1)
 #===============================================================================
 def test_ls_inexisting():
     # ls on a inexisting directory produces a nonzero return code (1), and a
     # diagnostic message on stderr
-    cmd = f"ls {os.path.join('data','inexisting')}"
-    with pytest.raises(NonZeroReturnCode):
-        try:
-            run(cmd,connection=leibniz1)
-        except NonZeroReturnCode as e: 
-            assert e.result.returncode != 0
-            assert bool(e.result.stderr)
-            raise
-    with pytest.raises(Stderr):
-        try:
-            run(cmd,stderr_is_error=True,check=False,connection=leibniz1)
-        except Stderr as e:
-            assert e.result.returncode != 0
-            assert bool(e.result.stderr)
-            raise
+    cmd = f"ls {os.path.join(scratch_dir,'inexisting')}"
+    # execute once, and check the result in two ways
+    result = run(cmd,check=False,connection=leibniz1)
+    assert result.returncode != 0
+    assert bool(result.stderr)
+    with pytest.raises(NonZeroReturnCode) as e:
+        raise_if_nonzero(result)
+    assert e.value.result is result
+    with pytest.raises(Stderr) as e:
+        raise_if_stderr(result)
+    assert e.value.result is result
+#===============================================================================
+def test_large_stdout_and_stderr():
+    # both streams must be read concurrently, or the command may never finish.
+    n = 1<<24
+    cmd = f"head -c {n} /dev/zero | tr '\\0' e >&2; head -c {n} /dev/zero | tr '\\0' o"
+    result = run(cmd,connection=leibniz1,timeout=60)
+    assert result.stdout == 'o'*n
+    assert result.stderr == 'e'*n
+#===============================================================================
+def test_invalid_utf8():
+    result = run(r"printf 'a\377b'; printf 'c\377d' >&2",connection=leibniz1)
+    assert result.stdout == 'a\ufffdb'
+    assert result.stderr == 'c\ufffdd'
+#===============================================================================
+def test_remote_shell():
+    with RemoteShell(leibniz1) as session:
+        for i in range(10):
+            result = run(f"echo {i}; echo {i} >&2",connection=leibniz1,session=session)
+            assert result.stdout == f'{i}\n'
+            assert result.stderr == f'{i}\n'
+        result = run("exit 3",connection=leibniz1,session=session,check=False)
+        assert result.returncode == 3
+        with pytest.raises(CommandTimedOut):
+            run("sleep 2",connection=leibniz1,session=session,timeout=.5)
+        # the shell is restarted after a timeout
+        assert run("echo ok",connection=leibniz1,session=session).stdout == 'ok\n'
+#===============================================================================
+def test_execute_many():
+    commands = [RemoteCommand(leibniz1,f"sleep 1; echo {i}") for i in range(30)]
+    start = time.monotonic()
+    results = asyncio.run(execute_many(commands,concurrency=30,attempts=1))
+    # at most max_sessions=10 commands run simultaneously over one connection,
+    # but they overlapped: executed one after the other they take 30s. 
+    # (Not a tighter bound, which fails on a loaded network or remote host.)
+    assert 3 <= time.monotonic()-start < 30/2
+    assert [result.stdout for result in results] == [f'{i}\n' for i in range(30)]
+#===============================================================================
+def test_run_async():
+    async def main():
+        return await asyncio.gather(*[ run_async(f"sleep 1; echo {i}",connection=leibniz1)
+                                       for i in range(6)
+                                     ])
+    start = time.monotonic()
+    results = asyncio.run(main())
+    # the commands overlapped: executed one after the other they take 6s.
+    assert time.monotonic()-start < 6/2
+    assert [result.stdout for result in results] == [f'{i}\n' for i in range(6)]
+#===============================================================================
+def test_max_sessions():
+    connection = Connection( leibniz1.login_node,username=me.username,ssh_key=me.sshkey
+                           , max_sessions=1
+                           )
+    try:
+        assert run('echo hello',connection=connection).stdout == 'hello\n'
+        connection.sftp() # holds the only channel
+        with pytest.raises(CommandTimedOut):
+            run('echo hello',connection=connection,timeout=.5)
+    finally:
+        connection.close()
+#===============================================================================
+def test_ssh_args():
+    ssh = ['ssh',*leibniz1.ssh_args(),leibniz1.login_node]
+    for _ in range(3):
+        # only the first invocation performs the ssh handshake
+        result = subprocess.run(ssh+['echo hello'],capture_output=True,text=True)
+        assert result.stdout == 'hello\n'
+    assert subprocess.run(ssh[:-1]+['-O','check',leibniz1.login_node]).returncode == 0
+    # the effective configuration (ssh -G does not connect)
+    config = subprocess.run(ssh[:1]+['-G']+ssh[1:],capture_output=True,text=True)
+    config = config.stdout.splitlines()
+    assert 'requesttty no' in config or 'requesttty false' in config
+    assert 'compression no' in config
+    assert f'user {me.username}' in config
+    assert any(line.startswith('ciphers aes128-gcm@openssh.com,') for line in config)
+#===============================================================================
+def test_use_agent(ssh_agent):
+    connection = Connection(leibniz1.login_node,username=me.username,use_agent=True)
+    try:
+        assert run('echo hello',connection=connection).stdout == 'hello\n'
+        ssh = ['ssh',*connection.ssh_args(),connection.login_node]
+        assert subprocess.run(ssh+['echo hello'],capture_output=True,text=True).stdout == 'hello\n'
+        subprocess.run(ssh[:-1]+['-O','exit',connection.login_node],capture_output=True)
+    finally:
+        connection.close()
 #===============================================================================
 def test_no_timeout():
     # this must not timeout
-    timeout = 5
+    timeout = 2
     sleep = timeout/4
     cmd = f"sleep {sleep}"
     result = run(cmd,connection=leibniz1,timeout=timeout)
@@ -155,21 +336,22 @@ def test_no_timeout():
     assert not bool(result.stdout)
     assert not bool(result.stderr)
 #===============================================================================
-def test_timeout(): 
+def test_timeout(lrcmd_log): 
     # this must timeout
-    cmd = 'tree data'
+    cmd = 'sleep 1'
     with pytest.raises(CommandTimedOut):
         run( cmd, connection=leibniz1
            , timeout=0.1
            , error_log=lrcmd_log
            )
 #===============================================================================
-def test_repeated_execution_fails():
+def test_repeated_execution_fails(lrcmd_log):
     with pytest.raises(RepeatedExecutionFailed):
         try:
+            # the retry logic itself is tested by test_fake_* in test_local.py
             run( "sleep 1",connection=leibniz1
-               , attempts=3, wait=.5
-               , timeout=.9
+               , attempts=2, wait=.1
+               , timeout=.2
                , verbose=True
                , error_log=lrcmd_log
                )
@@ -179,27 +361,18 @@ def test_repeated_execution_fails():
 #===============================================================================
 def test_repeated_execution_succeeds():
     # setup
-    newdir = os.path.join('data', 'newdir')
-    try:
-        remove(newdir, leibniz1)
-    except:
-        pass
-    assert not exists(newdir, leibniz1)
-    
+    newdir = os.path.join(scratch_dir,'newdir')
     src_sh = os.path.join(test_data_dir,'test_succeeds_the_second_time.sh')
-    assert exists('data',leibniz1)
-    dst_sh = os.path.join('data','test_succeeds_the_second_time.sh')
-    remove(dst_sh,leibniz1)
-    copy_local_to_remote(leibniz1,src_sh,dst_sh)    
-    assert     exists(dst_sh,leibniz1)
-    assert not exists(dst_sh,leibniz1,operator='-x')
-    run('chmod +x test_succeeds_the_second_time.sh',leibniz1,working_directory='data')
-    assert     exists(dst_sh,leibniz1,operator='-x')
+    dst_sh = os.path.join(scratch_dir,'test_succeeds_the_second_time.sh')
+    run_batch([f"rm -rf {newdir} {dst_sh}"])
+    # copy and make executable in one go
+    rsync_local_to_remote(leibniz1,src_sh,dst_sh,chmod='u+x')
+    assert exists(dst_sh,leibniz1,operator='-x')
     
     # test 
     # this command should succeeds the second time
     cmd = "./test_succeeds_the_second_time.sh"
-    result = run( cmd, leibniz1, working_directory='data'
+    result = run( cmd, leibniz1, working_directory=scratch_dir
                 , attempts=3, wait=.5
                 , verbose=True
                 )
@@ -207,60 +380,92 @@ def test_repeated_execution_succeeds():
     assert exists(newdir,leibniz1)
          
     # clean up
-    remove(newdir,leibniz1)
-    assert not exists(newdir,leibniz1)
-    remove(dst_sh,leibniz1)
-    assert not exists(dst_sh,leibniz1)
+    result = run_batch([f"rm -rf {newdir} {dst_sh}"
+                       ,f"[ -e {newdir} ] || [ -e {dst_sh} ] || echo removed"
+                       ])
+    assert result.stdout == 'removed\n'
+#===============================================================================
+def test_copy_local_to_remote():
+    src_sh = os.path.join(test_data_dir,'test_succeeds_the_second_time.sh')
+    dst_sh = os.path.join(scratch_dir,'copied.sh')
+    copy_local_to_remote(leibniz1,src_sh,dst_sh)
+    result = run_batch([f"cat {dst_sh}"
+                       ,f"rm -f {dst_sh}"
+                       ])
+    with open(src_sh) as f:
+        assert result.stdout == f.read()
+#===============================================================================
+def test_tar_to_remote_stderr():
+    # a local command writing more to stderr than a pipe holds must not block
+    local_cmd = ['sh','-c','head -c 1000000 /dev/zero | tr "\\0" x >&2; printf archive']
+    result, remote_result = _tar_to_remote(leibniz1,local_cmd,'cat',timeout=10)
+    assert result.returncode == 0 and len(result.stderr) == 1000000
+    assert remote_result.stdout == 'archive'
+#===============================================================================
+def test_copy_dir_local_to_remote(tmp_path):
+    for i in range(3):
+        (tmp_path/f'{i}.txt').write_text(f'{i}\n')
+    dst = os.path.join(scratch_dir,'copied_dir')
+    copy_local_to_remote(leibniz1,str(tmp_path),dst)
+    assert sorted(glob('*',path=dst,connection=leibniz1)) == ['0.txt','1.txt','2.txt']
+    remove(dst,connection=leibniz1)
+    
+    # the remote tar cannot create its directory below a file
+    not_a_dir = os.path.join(scratch_dir,'not_a_dir')
+    touch(not_a_dir,connection=leibniz1)
+    with pytest.raises(RemoteError) as exc_info:
+        copy_local_to_remote(leibniz1,str(tmp_path),os.path.join(not_a_dir,'copied_dir'))
+    assert exc_info.value.result.returncode != 0
+    assert exc_info.value.result.stderr
+    remove(not_a_dir,connection=leibniz1)
 #===============================================================================
 def test_touch():
-    path = os.path.join('data','touch')
-    if exists(path,connection=leibniz1):
-        remove(path,connection=leibniz1)
-    ensure_dir(path,connection=leibniz1)
+    path = os.path.join(scratch_dir,'touch')
+    # touch creates path if it does not exist
+    run_batch([f"rm -rf {path}"])
     
-    for file in ['a.txt','b.txt','c.txt']:
+    files = ['a.txt','b.txt','c.txt']
+    for file in files:
         touch(file,path=path,connection=leibniz1)
-    for file in ['a.txt','b.txt','c.txt']:
-        p = os.path.join(path,file)
-        assert exists(p,connection=leibniz1)
+    # a single glob, rather than testing every file
+    assert set(glob('*',path=path,connection=leibniz1)) == set(files)
         
     remove(path,connection=leibniz1)
 #===============================================================================
 def test_glob():
-    path = os.path.join('data','glob')
-    if exists(path,connection=leibniz1):
-        remove(path,connection=leibniz1)
-    ensure_dir(path,connection=leibniz1)
+    path = os.path.join(scratch_dir,'glob')
     files = ['a.txt','b.txt','c.txt','aa.txt']
-    for file in files:
-        touch(file,path=path,connection=leibniz1)
     dirs =['a.tx','d.txt']
-    for folder in dirs:
-        ensure_dir(os.path.join(path,folder),connection=leibniz1)
-        
+    run_batch([f"rm -rf {path}"
+              ,f"mkdir -p {' '.join(os.path.join(path,folder) for folder in dirs)}"
+              ,f"cd {path}"
+              ,f"touch {' '.join(files)}"
+              ])
+    # The setup knows which files exist: the remote glob must agree with 
+    # fnmatch, and not match the directories.
     result = glob('*.txt',path=path,connection=leibniz1)
     assert len(result)==4
-    for file in result:
-        assert file in files
+    assert sorted(result) == sorted(fnmatch.filter(files,'*.txt'))
          
     result = glob('?.txt',path=path,connection=leibniz1)
     assert len(result)==3
-    for file in result:
-        assert file in files
+    assert sorted(result) == sorted(fnmatch.filter(files,'?.txt'))
         
     # clean up
     remove(path,connection=leibniz1)
 #===============================================================================
-def test_rename():
+def test_rename(cached_exists):
     # set up
-    test_dir = os.path.join('data','rename')
-    ensure_dir(test_dir,connection=leibniz1)
+    test_dir = os.path.join(scratch_dir,'rename')
     old = os.path.join(test_dir,'old.txt')
-    touch(old,connection=leibniz1)
-    assert exists(old,connection=leibniz1)
+    run_batch([f"mkdir -p {test_dir}"
+              ,f"touch {old}"
+              ])
     
     # test
-    new = os.path.join(test_dir,'new.txt')
+    # paths are taken literally
+    new_dir = ensure_dir(os.path.join(test_dir,'a dir'),connection=leibniz1)
+    new = os.path.join(new_dir,'new $USER.txt')
     rename(old,new,connection=leibniz1)
     assert not exists(old,connection=leibniz1)
     assert     exists(new,connection=leibniz1)
@@ -268,16 +473,62 @@ def test_rename():
     # clean up
     remove(test_dir,connection=leibniz1)
 #===============================================================================
-def test_env():
-    user = env( 'USER',connection=leibniz1)
-    assert user == 'vsc20170'
-
-    user = env('$USER',connection=leibniz1)
-    assert user == 'vsc20170'
+def test_copy_glob_remote_to_local(tmp_path,monkeypatch):
+    # set up
+    test_dir = os.path.join(scratch_dir,'copy_glob')
+    copied_dir = os.path.join(test_dir,'copied')
+    files = [f'{i}.txt' for i in range(5)]
+    run_batch([f"rm -rf {test_dir}"
+              ,f"mkdir -p {copied_dir}"
+              ,f"cd {test_dir}"
+              ,*[f"echo {file} > {file}" for file in files]
+              ,"touch not_matching.dat"
+              ])
+    (tmp_path/'0.txt').write_text('local\n') # not overwritten
     
-    unknown = env( 'varthatdoesnotexist',connection=leibniz1)
-    assert unknown == ''
+    # test: 4 files copied over 2 channels, and moved in batches of 3
+    monkeypatch.setattr(lrcmd.commands,'_BATCH_SIZE',3)
+    copy_glob_remote_to_local( leibniz1,str(tmp_path),test_dir
+                             , pattern='*.txt',rename=copied_dir,max_channels=2
+                             )
+    assert sorted(os.listdir(tmp_path)) == files
+    for file in files:
+        assert (tmp_path/file).read_text() == ('local\n' if file=='0.txt' else f'{file}\n')
+    assert sorted(glob('*',path=test_dir,connection=leibniz1)) == ['0.txt','not_matching.dat']
+    assert sorted(glob('*',path=copied_dir,connection=leibniz1)) == files[1:]
+    
+    # clean up
+    remove(test_dir,connection=leibniz1)
+#===============================================================================
+def test_copy_glob_few_sessions(tmp_path):
+    # fewer channels available than max_channels: copy over those available
+    test_dir = os.path.join(scratch_dir,'copy_glob')
+    files = [f'{i}.txt' for i in range(20)]
+    run_batch([f"rm -rf {test_dir}"
+              ,f"mkdir -p {test_dir}"
+              ,f"cd {test_dir}"
+              ,f"touch {' '.join(files)}"
+              ])
+    connection = Connection( leibniz1.login_node,username=me.username,ssh_key=me.sshkey
+                           , max_sessions=4
+                           )
+    try:
+        with RemoteShell(connection): # holds a channel too
+            copy_glob_remote_to_local(connection,str(tmp_path),test_dir,max_channels=8)
+        assert sorted(os.listdir(tmp_path)) == sorted(files)
+    finally:
+        connection.close()
+    remove(test_dir,connection=leibniz1)
+#===============================================================================
+def test_env():
+    # read all variables in a single round trip
+    result = run('printf "%s\\n" "$USER" "$varthatdoesnotexist"',connection=leibniz1)
+    values = result.stdout.splitlines()
+    assert values == ['vsc20170','']
     
+    # env() strips the '$' ...
+    assert env('$USER',connection=leibniz1) == 'vsc20170'
+    # ... and printenv fails for an unknown variable
     unknown = env('$varthatdoesnotexist',connection=leibniz1)
     assert unknown == ''
 #===============================================================================
@@ -291,7 +542,9 @@ if __name__=="__main__":
     the_test_you_want_to_debug = test_repeated_execution_succeeds
 
     from execution_trace import trace
-    with trace(f"__main__ running {the_test_you_want_to_debug}",'-*# finished #*-',singleline=False,combine=False):
+    with trace( f"__main__ running {the_test_you_want_to_debug}",'-*# finished #*-'
+              , singleline=False,combine=False
+              ):
         the_test_you_want_to_debug()
 #===============================================================================
 